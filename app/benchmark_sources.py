@@ -0,0 +1,129 @@
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+import card.sources
+import core.network
+from card.components import ConditionOracle, LanguageOracle, SetOracle
+from core.network import FixtureArchive, FixtureMode
+from core.utils import StderrLogger
+
+
+def getSourceClassesByTitle():
+    classesByTitle = {}
+    for classObject in card.sources.getCardSourceClasses():
+        classesByTitle[classObject(StderrLogger(classObject.__name__)).getTitle()] = classObject
+    return classesByTitle
+
+
+def record(args):
+    classesByTitle = getSourceClassesByTitle()
+    sourceIds = args.sources or sorted(classesByTitle.keys())
+    with FixtureArchive(args.archive, FixtureMode.RECORD) as archive:
+        core.network.useFixtureArchive(archive)
+        try:
+            archive.metadata['queries'] = {}
+            for sourceId in sourceIds:
+                archive.metadata['queries'][sourceId] = []
+                for queryText in args.queries:
+                    cardSource = classesByTitle[sourceId](StderrLogger(sourceId))
+                    # noinspection PyBroadException
+                    try:
+                        numFound = sum(1 for cardInfo in cardSource.query(queryText) if cardInfo is not None)
+                    except Exception as ex:
+                        print('{} >= {}: FAIL {}'.format(queryText, sourceId, ex))
+                        continue
+                    archive.metadata['queries'][sourceId].append(queryText)
+                    print('{} >= {}: {} found'.format(queryText, sourceId, numFound))
+        finally:
+            core.network.useFixtureArchive(None)
+        print('{} responses recorded to {}'.format(archive.getEntriesCount(), args.archive))
+    return 0
+
+
+def runQuery(sourceClass, sourceId, queryText):
+    # Source is constructed in advance, so that oracles loading is not measured
+    cardSource = sourceClass(StderrLogger(sourceId))
+    startTime = time.perf_counter()
+    numFound = sum(1 for cardInfo in cardSource.query(queryText) if cardInfo is not None)
+    return numFound, time.perf_counter() - startTime
+
+
+def measureMemory(sourceClass, sourceId, queryText):
+    cardSource = sourceClass(StderrLogger(sourceId))
+    gc.collect()
+    blocksBefore = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        for _ in cardSource.query(queryText):
+            pass
+        _, peakBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return sys.getallocatedblocks() - blocksBefore, peakBytes
+
+
+def run(args):
+    classesByTitle = getSourceClassesByTitle()
+    with FixtureArchive(args.archive, FixtureMode.REPLAY) as archive:
+        core.network.useFixtureArchive(archive)
+        try:
+            print('{:<24} {:>8} {:>12} {:>12} {:>12} {:>12}'.format('source', 'offers', 'seconds', 'offers/sec', 'new blocks', 'peak KiB'))
+            for sourceId, queries in sorted(archive.metadata['queries'].items()):
+                if args.sources and sourceId not in args.sources:
+                    continue
+                sourceClass = classesByTitle[sourceId]
+                numFound = 0
+                totalTime = 0.0
+                allocatedBlocks = 0
+                peakBytes = 0
+                for queryText in queries:
+                    for _ in range(args.repeat):
+                        queryFound, queryTime = runQuery(sourceClass, sourceId, queryText)
+                        numFound += queryFound
+                        totalTime += queryTime
+                    queryBlocks, queryPeakBytes = measureMemory(sourceClass, sourceId, queryText)
+                    allocatedBlocks += queryBlocks
+                    peakBytes = max(peakBytes, queryPeakBytes)
+                print('{:<24} {:>8} {:>12.3f} {:>12.1f} {:>12} {:>12}'.format(
+                    sourceId, numFound, totalTime, numFound / totalTime if totalTime > 0 else 0, allocatedBlocks, peakBytes // 1024))
+            print()
+            print('{:<24} {:>12} {:>12} {:>12}'.format('oracle', 'hits', 'misses', 'entries'))
+            for oracleClass in (SetOracle, LanguageOracle, ConditionOracle):
+                stats = oracleClass(StderrLogger(oracleClass.__name__), thorough=False).get_memo_stats()
+                print('{:<24} {:>12} {:>12} {:>12}'.format(oracleClass.__name__, stats.hits, stats.misses, stats.entries))
+        finally:
+            core.network.useFixtureArchive(None)
+    return 0
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Measure card sources parsing performance on recorded responses')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    recordParser = subparsers.add_parser('record', help='query live shops and save their responses')
+    recordParser.add_argument('archive')
+    recordParser.add_argument('queries', nargs='+')
+    recordParser.add_argument('--source', dest='sources', action='append')
+    recordParser.set_defaults(handler=record)
+
+    runParser = subparsers.add_parser('run', help='parse recorded responses')
+    runParser.add_argument('archive')
+    runParser.add_argument('--source', dest='sources', action='append')
+    runParser.add_argument('--repeat', type=int, default=5)
+    runParser.set_defaults(handler=run)
+
+    parsedArgs = parser.parse_args(args)
+    return parsedArgs.handler(parsedArgs)
+
+
+if __name__ == '__main__':
+    rc = 1
+    try:
+        rc = main(sys.argv[1:])
+    except KeyboardInterrupt:
+        pass
+    sys.exit(rc)
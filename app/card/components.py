@@ -1,53 +1,203 @@
 import re
 import string
-from typing import Optional
+import threading
+from typing import List, Optional, Pattern, Set, Tuple
 
+from core.cache import CacheStats, LruCache
 from core.utils import load_json_resource, ILogger, StringUtils
 
+PATTERN_FLAGS = re.IGNORECASE | re.UNICODE
+ORACLE_MEMO_SIZE = 4096
 
-class BaseOracle(object):
-    def __init__(self, entity: str, resource_id: str, thorough: bool, logger: ILogger, name_character_set: str):
-        self.__entity = entity
-        self.__thorough = thorough
-        self.__logger = logger
+
+def _skip_quantifier(pattern: str, i: int) -> Tuple[int, bool]:
+    # Returns position after the quantifier at i (if any) and whether the quantified item may be skipped
+    if i < len(pattern) and pattern[i] in '?*+{':
+        optional = pattern[i] in '?*' or (pattern[i] == '{' and pattern[i + 1:i + 2] in ('0', ','))
+        i = pattern.index('}', i) + 1 if pattern[i] == '{' else i + 1
+        if i < len(pattern) and pattern[i] in '?+':
+            i += 1
+        return i, optional
+    return i, False
+
+
+def _split_pattern(pattern: str) -> Tuple[List[str], List[int]]:
+    # Splits pattern into top level alternatives and finds positions of closing parentheses of all groups
+    alternatives, group_ends, group_starts = [], [], []
+    start, i = 0, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            i = pattern.index(']', i + 2)
+        elif c == '(':
+            group_starts.append(i)
+        elif c == ')':
+            group_starts.pop()
+            if len(group_starts) == 0:
+                group_ends.append(i)
+        elif c == '|' and len(group_starts) == 0:
+            alternatives.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    alternatives.append(pattern[start:])
+    return alternatives, group_ends
+
+
+def _get_first_characters(pattern: str) -> Optional[Set[str]]:
+    # Returns characters that any match of the pattern starts with, or None when they are not known.
+    # Only the regular expressions subset used by resources is supported, anything else is reported as unknown
+    result = set()
+    for alternative in _split_pattern(pattern)[0]:
+        characters = set()
+        i = 0
+        while True:
+            if i >= len(alternative):
+                return None  # Alternative matches empty string
+            c = alternative[i]
+            if c == '(':
+                end = _split_pattern(alternative[i:])[1][0]
+                inner = alternative[i + 1:i + end]
+                if inner.startswith('?:'):
+                    inner = inner[2:]
+                elif inner.startswith('?'):
+                    return None
+                item_characters = _get_first_characters(inner)
+                i += end + 1
+            elif c == '\\':
+                if i + 1 >= len(alternative) or alternative[i + 1].isalnum():
+                    return None
+                item_characters = {alternative[i + 1]}
+                i += 2
+            elif c in '[.^$':
+                return None
+            else:
+                item_characters = {c}
+                i += 1
+            if item_characters is None:
+                return None
+            characters |= item_characters
+            i, optional = _skip_quantifier(alternative, i)
+            if not optional:
+                break
+        result |= characters
+    return result
+
+
+class OracleSnapshot(object):
+    # Everything an oracle knows about its resource. Snapshots are read-only once built, so one snapshot per resource
+    # is shared by all oracles of the process. Regular expressions take most of the building time, so they are compiled on first use
+    def __init__(self, resource_id: str, name_character_set: Set[str]):
         self.__name_characters = name_character_set
-        self.__abbrvs_by_name_key = {}
-        self.__names_by_abbrv = {}
-        self.__patterns_by_abbrv = {}
+        self.names_by_abbrv = {}
+        self.abbrvs_by_name_key = {}
+        self.__pattern_sources = []
+        self.__patterns = {}
+        self.__matchers = {}
+        patterns_by_first_character = {}
+        generic_patterns = []
         for abbreviation, (name, pattern) in load_json_resource(resource_id).items():
             if pattern is None:
                 pattern = name
-            self.__abbrvs_by_name_key[self.__get_name_key(name)] = abbreviation
-            self.__names_by_abbrv[abbreviation] = name
-            self.__patterns_by_abbrv[abbreviation] = re.compile(r'^({})$'.format(pattern), re.IGNORECASE | re.UNICODE)
+            self.abbrvs_by_name_key[self.get_name_key(name)] = abbreviation
+            self.names_by_abbrv[abbreviation] = name
+            first_characters = _get_first_characters(pattern)
+            if first_characters is None:
+                generic_patterns.append(len(self.__pattern_sources))
+            else:
+                for character in first_characters:
+                    patterns_by_first_character.setdefault(character.lower(), []).append(len(self.__pattern_sources))
+            self.__pattern_sources.append((abbreviation, pattern))
+
+        # Patterns that a candidate can match are joined into one alternation per first character of the candidate,
+        # so that recognition takes a single pass of the regular expressions engine instead of one pass per pattern.
+        # Alternatives keep the resource order, so the first matching pattern wins just like when they are checked one by one
+        self.__matcher_patterns = {character: sorted(set(indices + generic_patterns)) for character, indices in patterns_by_first_character.items()}
+        self.__matcher_patterns[None] = generic_patterns
 
-    def __get_name_key(self, value) -> str:
+    def get_name_key(self, value) -> str:
         return ''.join(c for c in value.lower() if c in self.__name_characters)
 
+    def get_patterns_count(self) -> int:
+        return len(self.__pattern_sources)
+
+    def get_abbreviation(self, index: int) -> str:
+        return self.__pattern_sources[index][0]
+
+    def get_pattern(self, index: int) -> Pattern:
+        pattern = self.__patterns.get(index)
+        if pattern is None:
+            pattern = re.compile(r'^({})$'.format(self.__pattern_sources[index][1]), PATTERN_FLAGS)
+            self.__patterns[index] = pattern
+        return pattern
+
+    def get_matcher(self, first_character: str) -> Optional[Pattern]:
+        key = first_character if first_character in self.__matcher_patterns else None
+        if key not in self.__matchers:
+            indices = self.__matcher_patterns[key]
+            self.__matchers[key] = re.compile(r'^(?:{})$'.format('|'.join(
+                '(?P<p{}>{})'.format(i, self.__pattern_sources[i][1]) for i in indices)), PATTERN_FLAGS) if len(indices) > 0 else None
+        return self.__matchers[key]
+
+
+class BaseOracle(object):
+    __SNAPSHOTS = {}
+    __SNAPSHOTS_LOCK = threading.Lock()
+    __MEMOS = {}
+
+    def __init__(self, entity: str, resource_id: str, thorough: bool, logger: ILogger, name_character_set: Set[str]):
+        self.__entity = entity
+        self.__thorough = thorough
+        self.__logger = logger
+        with self.__SNAPSHOTS_LOCK:
+            if resource_id not in self.__SNAPSHOTS:
+                self.__SNAPSHOTS[resource_id] = OracleSnapshot(resource_id, name_character_set)
+            self.__snapshot = self.__SNAPSHOTS[resource_id]
+
+        # Shops repeat the same few strings for every offer, so results (unrecognized strings too) are remembered
+        # and shared by all oracles of the same kind in the process
+        self.__memo = self.__MEMOS.setdefault((resource_id, thorough), LruCache(ORACLE_MEMO_SIZE))
+
     def get_name(self, abbreviation: str) -> str:
-        return self.__names_by_abbrv[abbreviation]
+        return self.__snapshot.names_by_abbrv[abbreviation]
+
+    def get_memo_stats(self) -> CacheStats:
+        return self.__memo.get_stats()
 
     def get_abbreviation(self, candidate: str, quiet: bool = False) -> Optional[str]:
+        memo_entry = self.__memo.get(candidate)
+        if memo_entry is None:
+            memo_entry = (self.__recognize(candidate), False)
+            self.__memo.put(candidate, memo_entry, 1)
+        abbreviation, warned = memo_entry
+        if abbreviation is None and not quiet and not warned:
+            self.__logger.warning('Unable to recognize %s "%s"', self.__entity, candidate)
+            self.__memo.put(candidate, (abbreviation, True), 1)
+        return abbreviation
+
+    def __recognize(self, candidate: str) -> Optional[str]:
+        snapshot = self.__snapshot
         cleaned_candidate = candidate.strip().upper()
-        if cleaned_candidate in self.__names_by_abbrv:
+        if cleaned_candidate in snapshot.names_by_abbrv:
             return cleaned_candidate
 
-        candidate_key = self.__get_name_key(cleaned_candidate)
-        if candidate_key in self.__abbrvs_by_name_key:
-            return self.__abbrvs_by_name_key[candidate_key]
-
-        matches = []
-        for abbreviation, regexp in self.__patterns_by_abbrv.items():
-            if regexp.match(cleaned_candidate):
-                if not self.__thorough:
-                    return abbreviation
-                matches.append(abbreviation)
-        if self.__thorough and len(matches) > 0:
+        candidate_key = snapshot.get_name_key(cleaned_candidate)
+        if candidate_key in snapshot.abbrvs_by_name_key:
+            return snapshot.abbrvs_by_name_key[candidate_key]
+
+        matcher = snapshot.get_matcher(cleaned_candidate[:1].lower())
+        match = matcher.match(cleaned_candidate) if matcher is not None else None
+        if match is not None:
+            first_index = int(match.lastgroup[1:])
+            abbreviation = snapshot.get_abbreviation(first_index)
+            if not self.__thorough:
+                return abbreviation
+            matches = [abbreviation] + [snapshot.get_abbreviation(i) for i in range(first_index + 1, snapshot.get_patterns_count())
+                                        if snapshot.get_pattern(i).match(cleaned_candidate)]
             if len(matches) > 1:
                 raise Exception('Found {} for "{}"'.format(', '.join(matches), candidate))
-            return matches[0]
-        if not quiet:
-            self.__logger.warning('Unable to recognize %s "%s"', self.__entity, candidate)
+            return abbreviation
         return None
 
 
@@ -1,9 +1,13 @@
-import copy
+from typing import Iterable, List
 
 from card.components import SetOracle, LanguageOracle
+from card.offers import CardOffer
 from card.utils import CardUtils
+from core.cache import CacheStats, LruCache
 from core.utils import ILogger
 
+FIXES_MEMO_SIZE = 16384
+
 
 class CardsFixer(object):
     def __init__(self, cardsInfo, cardsNames, setOracle: SetOracle, langOracle: LanguageOracle, logger: ILogger):
@@ -37,56 +41,87 @@ class CardsFixer(object):
                 if cardInfo[0] is not None:
                     self.cardsIds.setdefault(setKey, {})[cardKey] = cardInfo[0]
 
-    def fixCardInfo(self, cardInfo):
-        cardInfo = copy.deepcopy(cardInfo)
-        cardInfo['name']['caption'] = CardUtils.get_primary_name(cardInfo['name']['caption'])
+        # Everything that does not depend on a particular offer is computed in advance, so that fixing an offer takes a few lookups
+        self.setsLanguage = {}
+        for setKey, setLanguages in self.setsLanguages.items():
+            if len(setLanguages) == 1:
+                self.setsLanguage[setKey] = self.langOracle.get_abbreviation(setLanguages[0])
+        self.cardsOnlySets = {}
+
+        # Search results mostly consist of the same few cards in a few sets, so fixes are remembered by everything they depend on
+        self.fixesMemo = LruCache(FIXES_MEMO_SIZE)
+
+    def __getOnlySets(self, cardKey) -> dict:
+        # Maps offer foilness to the only set the card could be printed in with such foilness. Computed on demand for every card
+        onlySets = self.cardsOnlySets.get(cardKey)
+        if onlySets is None:
+            cardSets = self.cardSets.get(cardKey)
+            if cardSets is None:
+                return {}
+            onlySets = {}
+            for cardFoilness in (None, False, True):
+                matchedSets = []
+                for setKey in cardSets:
+                    setFoilness = self.setsFoilness.get(setKey)
+                    if setFoilness is None or cardFoilness is None or setFoilness == cardFoilness:
+                        matchedSets.append(setKey)
+                if len(matchedSets) == 1:
+                    onlySets[cardFoilness] = matchedSets[0]
+            self.cardsOnlySets[cardKey] = onlySets
+        return onlySets
+
+    def getMemoStats(self) -> CacheStats:
+        return self.fixesMemo.get_stats()
+
+    def fixBatch(self, cardsInfo: Iterable[CardOffer]) -> List[CardOffer]:
+        return [self.fixCardInfo(cardInfo) for cardInfo in cardsInfo]
 
-        cardKey = CardUtils.make_key(cardInfo['name']['caption'])
+    def fixCardInfo(self, cardInfo: CardOffer) -> CardOffer:
+        # Offer is not modified, fixed values are put into a new one
+        memoKey = (cardInfo.caption, cardInfo.set, cardInfo.foilness)
+        fix = self.fixesMemo.get(memoKey)
+        if fix is None:
+            fix = self.__findFix(*memoKey)
+            self.fixesMemo.put(memoKey, fix, 1)
+        caption, cardSet, keepId, cardId, keepLanguage, language, foilness = fix
+        return CardOffer(cardInfo.id if keepId else cardId, caption, cardInfo.description if cardInfo.description is not None else '', cardSet,
+                         cardInfo.language if keepLanguage else language, cardInfo.condition, foilness, cardInfo.count, cardInfo.price, cardInfo.currency,
+                         cardInfo.source, cardInfo.url)
+
+    def __findFix(self, caption, cardSet, foilness) -> tuple:
+        # Returns fixed caption, set and foilness, offer id and language are either kept as is or replaced with the given values
+        keepId, cardId, keepLanguage, language = True, None, True, None
+        caption = CardUtils.get_primary_name(caption)
+
+        cardKey = CardUtils.make_key(caption)
         if cardKey in self.cardsNames:
-            newCardName = self.cardsNames[cardKey][0]
-            cardInfo['name']['caption'] = newCardName
-            cardKey = CardUtils.make_key(newCardName)
-
-        if 'description' not in cardInfo['name'] or cardInfo['name']['description'] is None:
-            cardInfo['name']['description'] = ''
-
-        cardSets = self.cardSets.get(cardKey, set())
-        oldCardSet = cardInfo.get('set')
-        if oldCardSet is not None:
-            oldCardSetKey = self.setOracle.get_abbreviation(oldCardSet)
-            if oldCardSetKey is None:
-                self.logger.warning('Unknown set %s on card %s', oldCardSet, cardKey)
-            if oldCardSetKey is None or oldCardSetKey in self.cardsIds and cardKey not in self.cardsIds[oldCardSetKey]:
-                del cardInfo['set']
-                if 'id' in cardInfo:
-                    del cardInfo['id']
-
-        matchedSets = []
-        for possibleSet in cardSets:
-            possibleSetKey = self.setOracle.get_abbreviation(possibleSet)
-            if possibleSetKey is None:
-                self.logger.warning('Unknown internal set %s', possibleSet)
-            if possibleSetKey is not None:
-                cardFoilness = cardInfo.get('foilness')
-                setFoilness = self.setsFoilness.get(possibleSetKey)
-                if setFoilness is None or cardFoilness is None or setFoilness == cardFoilness:
-                    matchedSets.append(possibleSetKey)
-        if len(matchedSets) == 1:
-            cardInfo['set'] = matchedSets[0]
-
-        newCardSet = cardInfo.get('set')
-        if newCardSet is not None:
-            newCardSetKey = self.setOracle.get_abbreviation(newCardSet)
-            if newCardSetKey in self.cardsIds:
-                newCardId = self.cardsIds[newCardSetKey].get(cardKey, None)
+            caption = self.cardsNames[cardKey][0]
+            cardKey = CardUtils.make_key(caption)
+
+        cardSetKey = None
+        if cardSet is not None:
+            cardSetKey = self.setOracle.get_abbreviation(cardSet)
+            if cardSetKey is None:
+                self.logger.warning('Unknown set %s on card %s', cardSet, cardKey)
+            if cardSetKey is None or cardSetKey in self.cardsIds and cardKey not in self.cardsIds[cardSetKey]:
+                cardSet = cardSetKey = None
+                keepId, cardId = False, None
+
+        onlySet = self.__getOnlySets(cardKey).get(foilness)
+        if onlySet is not None:
+            cardSet = cardSetKey = onlySet
+
+        if cardSet is not None:
+            if cardSetKey in self.cardsIds:
+                newCardId = self.cardsIds[cardSetKey].get(cardKey, None)
                 if newCardId is not None:
-                    cardInfo['id'] = newCardId
+                    keepId, cardId = False, newCardId
 
-            if newCardSetKey in self.setsLanguages and len(self.setsLanguages[newCardSetKey]) == 1:
-                cardInfo['language'] = self.langOracle.get_abbreviation(self.setsLanguages[newCardSetKey][0])
+            if cardSetKey in self.setsLanguage:
+                keepLanguage, language = False, self.setsLanguage[cardSetKey]
 
-            setFoilness = self.setsFoilness.get(newCardSetKey, None)
+            setFoilness = self.setsFoilness.get(cardSetKey, None)
             if setFoilness is not None:
-                cardInfo['foilness'] = setFoilness
+                foilness = setFoilness
 
-        return cardInfo
+        return caption, cardSet, keepId, cardId, keepLanguage, language, foilness
@@ -0,0 +1,56 @@
+import decimal
+import pickle
+import sys
+from typing import Iterable, List, Optional
+
+from core.utils import Currency
+
+OFFER_FIELDS = ('id', 'caption', 'description', 'set', 'language', 'condition', 'foilness', 'count', 'price', 'currency', 'source', 'url')
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class CardOffer(object):
+    # Tables of popular cards hold thousands of offers, so they are kept as compact as possible.
+    # Codes and captions repeat a lot, so equal strings are shared instead of being stored for every offer
+    __slots__ = OFFER_FIELDS
+
+    def __init__(self, offer_id: Optional[int] = None, caption: str = '', description: Optional[str] = None, set_id: Optional[str] = None,
+                 language: Optional[str] = None, condition: Optional[str] = None, foilness: Optional[bool] = None, count=None,
+                 price: Optional[decimal.Decimal] = None, currency: Optional[Currency] = None, source: str = '', url: str = ''):
+        self.id = offer_id
+        self.caption = caption
+        self.description = description
+        self.set = _intern(set_id)
+        self.language = _intern(language)
+        self.condition = _intern(condition)
+        self.foilness = foilness
+        self.count = count
+        self.price = price
+        self.currency = currency
+        self.source = _intern(source)
+        self.url = url
+
+    def to_tuple(self) -> tuple:
+        return (self.id, self.caption, self.description, self.set, self.language, self.condition, self.foilness, self.count, self.price, self.currency,
+                self.source, self.url)
+
+    def copy(self) -> 'CardOffer':
+        return CardOffer(*self.to_tuple())
+
+    def __eq__(self, other):
+        return isinstance(other, CardOffer) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self):
+        return 'CardOffer({})'.format(', '.join('{}={!r}'.format(field, value) for field, value in zip(OFFER_FIELDS, self.to_tuple())))
+
+
+def pack_offers(offers: Iterable[CardOffer]) -> bytes:
+    # Offers are sent between processes as plain tuples, so neither field names nor classes are pickled for every offer
+    return pickle.dumps([offer.to_tuple() for offer in offers], pickle.HIGHEST_PROTOCOL)
+
+
+def unpack_offers(block: bytes) -> List[CardOffer]:
+    return [CardOffer(*row) for row in pickle.loads(block)]
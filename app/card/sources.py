@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import asyncio
 import decimal
 import http
 import json
@@ -11,17 +12,31 @@ import time
 import urllib
 import urllib.error
 import urllib.parse
-from typing import List, Optional, Tuple
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
 
+import lxml.cssselect
+import lxml.etree
 import lxml.html
 
 import core.network
 from card.components import SetOracle, ConditionOracle, LanguageOracle
+from card.offers import CardOffer
 from card.utils import CardUtils
+from core.cache import LruCache
 from core.utils import ILogger, load_json_resource, StringUtils, LangUtils
 
 
 class CardSource(object):
+    __QUERY_FINISHED = object()
+    # Compiled selectors are shared by all sources of the process, so each selector is translated to XPath only once
+    __SELECTORS = {}
+    # Rough ratio between memory taken by parsed lxml tree and size of its source markup
+    __DOM_SIZE_FACTOR = 4
+    __STREAM_CHUNK_SIZE_BYTES = 64 * 1024
+    # Root of the shop, known without constructing a source so that sources can be planned by their hosts
+    URL = None
+
     def __init__(self, logger: ILogger, url: str, queryUrlTemplate: str, queryEncoding: str = 'utf-8', responseEncoding: str = 'utf-8', setMap=None):
         self.url = url
         self.queryUrlTemplate = url + queryUrlTemplate
@@ -32,8 +47,14 @@ class CardSource(object):
         self.wasEstimated = False
         self.estimatedCardsCount = None
         self.estimatedCardsPerPageCount = None
-        self.requestCache = {}
+        self.requestCache = LruCache(16 * 1024 * 1024)
+        self.cacheRawResponses = False
         self.verifySsl = True
+        self.responseCacheTtl = 15 * 60
+        self.maxConcurrentRequests = 4
+        self.requestsExecutor = None
+        # (tag, class) of entries to be parsed one by one with _parseEntry while response is still being parsed
+        self.streamedEntry = None
         self.currentQuery = None
         self.logger = logger.get_child(self.getTitle())
         self.langOracle = LanguageOracle(self.logger, thorough=False)
@@ -59,10 +80,49 @@ class CardSource(object):
 
     def getHtml(self, url: str):
         url = self.makeAbsUrl(url)
-        if url not in self.requestCache:
-            byteString = core.network.getUrl(url, self.logger, None, False, self.verifySsl)
-            self.requestCache[url] = lxml.html.document_fromstring(byteString.decode(self.responseEncoding))
-        return self.requestCache.get(url)
+        cachedResponse = self.requestCache.get(url)
+        if cachedResponse is None:
+            byteString = core.network.getUrl(url, self.logger, None, False, self.verifySsl, self.responseCacheTtl)
+            html = self.__parseHtml(byteString)
+            if self.cacheRawResponses:
+                self.requestCache.put(url, byteString, len(byteString))
+            else:
+                self.requestCache.put(url, html, len(byteString) * self.__DOM_SIZE_FACTOR)
+            return html
+        if self.cacheRawResponses:
+            return self.__parseHtml(cachedResponse)
+        return cachedResponse
+
+    def __parseHtml(self, byteString: bytes):
+        return lxml.html.document_fromstring(byteString.decode(self.responseEncoding))
+
+    def iterHtmlEntries(self, url: str, tag: str, className: str) -> Iterator[lxml.html.HtmlElement]:
+        # Yields matching elements as soon as they are closed, without building the whole document tree
+        byteString = core.network.getUrl(self.makeAbsUrl(url), self.logger, None, False, self.verifySsl, self.responseCacheTtl)
+        parser = lxml.etree.HTMLPullParser(events=('end',), tag=tag, encoding=self.responseEncoding)
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        for offset in range(0, len(byteString), self.__STREAM_CHUNK_SIZE_BYTES):
+            parser.feed(byteString[offset:offset + self.__STREAM_CHUNK_SIZE_BYTES])
+            yield from self.__readHtmlEntries(parser, className)
+        parser.close()
+        yield from self.__readHtmlEntries(parser, className)
+
+    @staticmethod
+    def __readHtmlEntries(parser: lxml.etree.HTMLPullParser, className: str) -> Iterator[lxml.html.HtmlElement]:
+        for _, element in parser.read_events():
+            if className in element.get('class', '').split():
+                yield element
+                # Entry is processed, so it and everything before it may be discarded
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    def select(self, element, selector: str) -> list:
+        compiledSelector = self.__SELECTORS.get(selector)
+        if compiledSelector is None:
+            compiledSelector = lxml.cssselect.CSSSelector(selector, translator='html')
+            self.__SELECTORS[selector] = compiledSelector
+        return compiledSelector(element)
 
     @staticmethod
     def packName(caption, description=None):
@@ -77,20 +137,37 @@ class CardSource(object):
         result = {'caption': caption, 'url': cardUrl or caption}
         return result
 
-    def __fillCardInfo(self, cardInfo: dict) -> dict:
-        cardInfo.setdefault('language', None)
-        if isinstance(cardInfo['name'], str):
-            cardInfo['name'] = self.packName(cardInfo['name'])
-        if cardInfo.get('condition') is not None:
-            cardInfo['condition'] = self.conditionOracle.get_abbreviation(cardInfo['condition'])
-        if cardInfo.get('set') is not None:
-            cardInfo['set'] = self.setOracle.get_abbreviation(self.sourceSpecificSets.get(cardInfo['set'], cardInfo['set']))
-        if cardInfo.get('language') is not None:
-            cardInfo['language'] = self.langOracle.get_abbreviation(cardInfo['language'])
-        if isinstance(cardInfo['source'], str):
-            cardInfo['source'] = self.packSource(self.getTitle(), cardInfo['source'])
+    def __handleParsedCard(self, cardInfo) -> Optional[CardOffer]:
+        if isinstance(cardInfo, dict):
+            # noinspection PyTypeChecker
+            return self.__fillCardInfo(cardInfo)
+        if isinstance(cardInfo, int):
+            self.estimatedCardsCount -= cardInfo
+            return None
+        if cardInfo is None:
+            self.estimatedCardsCount -= 1
+            return None
+        raise Exception('Unhandled card info type')
+
+    def __fillCardInfo(self, cardInfo: dict) -> CardOffer:
+        name = cardInfo['name']
+        if isinstance(name, str):
+            name = self.packName(name)
+        condition = cardInfo.get('condition')
+        if condition is not None:
+            condition = self.conditionOracle.get_abbreviation(condition)
+        setId = cardInfo.get('set')
+        if setId is not None:
+            setId = self.setOracle.get_abbreviation(self.sourceSpecificSets.get(setId, setId))
+        language = cardInfo.get('language')
+        if language is not None:
+            language = self.langOracle.get_abbreviation(language)
+        source = cardInfo['source']
+        if isinstance(source, str):
+            source = self.packSource(self.getTitle(), source)
         self.foundCardsCount += 1
-        return cardInfo
+        return CardOffer(cardInfo.get('id'), name['caption'], name.get('description'), setId, language, condition, cardInfo.get('foilness'),
+                         cardInfo.get('count'), cardInfo.get('price'), cardInfo.get('currency'), source['caption'], source['url'])
 
     def getFoundCardsCount(self):
         return self.foundCardsCount
@@ -99,7 +176,12 @@ class CardSource(object):
         return self.estimatedCardsCount
 
     def query(self, queryText):
+        # Instances may be reused for several searches, so nothing is kept from the previous one
         self.currentQuery = queryText
+        self.foundCardsCount = 0
+        self.wasEstimated = False
+        self.estimatedCardsPerPageCount = None
+        self.requestCache.clear()
 
         preloadedCards = self._searchPreloaded(queryText)
         self.estimatedCardsCount = len(preloadedCards)
@@ -107,57 +189,117 @@ class CardSource(object):
             if cardInfo is not None:
                 yield self.__fillCardInfo(cardInfo)
 
-        loopIndex = 0
-        pageIndex = 0
-        pageCount = 0
-        while pageIndex <= pageCount:
-            pageIndex = loopIndex + 1
-            escapedQuery = self.escapeQueryText(queryText)
-            try:
-                encodedQuery = escapedQuery.encode(self.queryEncoding)
-            except UnicodeEncodeError:
-                encodedQuery = escapedQuery
-            requestUrl = self.queryUrlTemplate.format(**{'query': urllib.parse.quote(encodedQuery), 'page': pageIndex})
-            response = self.getHtml(requestUrl)
-            if response is None:
-                continue
+        if self.streamedEntry is not None:
+            yield from self.__queryStreamed(queryText)
+            return
 
-            if not pageCount:
-                pageCount = max(1, self._getPageCount(response))
-            expectedPageCardsCount = self._getPageCardsCount(response)
-            if not self.wasEstimated:
-                self.wasEstimated = True
-                self.estimatedCardsPerPageCount = expectedPageCardsCount
-                if self.estimatedCardsCount is None:
-                    self.estimatedCardsCount = 0
-                totalCount = self._getTotalCardsCount(response)
-                if totalCount is None:
-                    totalCount = pageCount * expectedPageCardsCount
-                self.estimatedCardsCount += totalCount
-            if expectedPageCardsCount < self.estimatedCardsPerPageCount:
-                self.estimatedCardsCount -= self.estimatedCardsPerPageCount - expectedPageCardsCount
-
-            pageCards = 0
-            for cardInfo in self._parseResponse(queryText, requestUrl, response):
-                if isinstance(cardInfo, dict):
-                    # noinspection PyTypeChecker
-                    cardInfo = self.__fillCardInfo(cardInfo)
-                    pageCards += 1
-                elif isinstance(cardInfo, int):
-                    self.estimatedCardsCount -= cardInfo
-                    cardInfo = None
-                elif cardInfo is None:
-                    self.estimatedCardsCount -= 1
+        pageIndex = 1
+        pageCount = 0
+        prefetchedPages = {}
+        try:
+            while pageIndex <= max(1, pageCount):
+                requestUrl = self.__getQueryUrl(queryText, pageIndex)
+                if pageIndex in prefetchedPages:
+                    response = prefetchedPages.pop(pageIndex).result()
                 else:
-                    raise Exception('Unhandled card info type')
-                yield cardInfo
-            if pageCards == 0:
-                self.estimatedCardsCount = self.foundCardsCount
-                yield None
-                break
+                    response = self.getHtml(requestUrl)
+                pageIndex += 1
+                if response is None:
+                    continue
 
-            loopIndex += 1
-            pageIndex = loopIndex + 1
+                if not pageCount:
+                    pageCount = max(1, self._getPageCount(response))
+                    # Page count is known now, so the rest of the pages are loaded while this one is being parsed
+                    for nextPageIndex in range(pageIndex, pageCount + 1):
+                        prefetchedPages[nextPageIndex] = self.prefetchHtml(self.__getQueryUrl(queryText, nextPageIndex))
+                expectedPageCardsCount = self._getPageCardsCount(response)
+                if not self.wasEstimated:
+                    self.wasEstimated = True
+                    self.estimatedCardsPerPageCount = expectedPageCardsCount
+                    if self.estimatedCardsCount is None:
+                        self.estimatedCardsCount = 0
+                    totalCount = self._getTotalCardsCount(response)
+                    if totalCount is None:
+                        totalCount = pageCount * expectedPageCardsCount
+                    self.estimatedCardsCount += totalCount
+                if expectedPageCardsCount < self.estimatedCardsPerPageCount:
+                    self.estimatedCardsCount -= self.estimatedCardsPerPageCount - expectedPageCardsCount
+
+                pageCards = 0
+                for parsedCard in self._parseResponse(queryText, requestUrl, response):
+                    cardInfo = self.__handleParsedCard(parsedCard)
+                    if cardInfo is not None:
+                        pageCards += 1
+                    yield cardInfo
+                if pageCards == 0:
+                    self.estimatedCardsCount = self.foundCardsCount
+                    yield None
+                    break
+        finally:
+            # Search was either stopped or has run out of cards earlier than expected
+            for future in prefetchedPages.values():
+                future.cancel()
+
+    def __queryStreamed(self, queryText: str) -> Iterator[Optional[CardOffer]]:
+        requestUrl = self.__getQueryUrl(queryText, 1)
+        for entry in self.iterHtmlEntries(requestUrl, *self.streamedEntry):
+            # Total count is unknown until the whole page is parsed, so estimation grows along with parsed entries
+            self.estimatedCardsCount += 1
+            for parsedCard in self._parseEntry(queryText, requestUrl, entry):
+                yield self.__handleParsedCard(parsedCard)
+        self.estimatedCardsCount = self.foundCardsCount
+        yield None
+
+    def __getQueryUrl(self, queryText: str, pageIndex: int) -> str:
+        escapedQuery = self.escapeQueryText(queryText)
+        try:
+            encodedQuery = escapedQuery.encode(self.queryEncoding)
+        except UnicodeEncodeError:
+            encodedQuery = escapedQuery
+        return self.queryUrlTemplate.format(**{'query': urllib.parse.quote(encodedQuery), 'page': pageIndex})
+
+    def close(self) -> None:
+        # Releases what the source has accumulated, it is still usable afterwards
+        self.requestCache.clear()
+        if self.requestsExecutor is not None:
+            self.requestsExecutor.shutdown(wait=False)
+            self.requestsExecutor = None
+
+    def prefetchHtml(self, url: str) -> Future:
+        if self.requestsExecutor is None:
+            self.requestsExecutor = ThreadPoolExecutor(self.maxConcurrentRequests)
+        return self.requestsExecutor.submit(self.getHtml, url)
+
+    def getHtmlPages(self, urls: List[str]) -> Iterator[Tuple[int, lxml.html.HtmlElement]]:
+        # Yields (index in urls, page) pairs in order of completion, not in order of urls
+        indicesByFuture = {}
+        futuresByUrl = {}
+        for i, url in enumerate(urls):
+            if url not in futuresByUrl:
+                futuresByUrl[url] = self.prefetchHtml(url)
+            indicesByFuture.setdefault(futuresByUrl[url], []).append(i)
+        try:
+            for future in as_completed(indicesByFuture):
+                html = future.result()
+                for i in indicesByFuture[future]:
+                    yield i, html
+        finally:
+            for future in indicesByFuture:
+                future.cancel()
+
+    async def queryAsync(self, queryText: str, executor: Optional[Executor] = None) -> AsyncIterator[Optional[CardOffer]]:
+        # Parsers do blocking network calls on their own (detail pages, promo pages), so every step of the synchronous
+        # query is run in the executor, leaving the event loop free to drive other sources in the meantime
+        loop = asyncio.get_event_loop()
+        results = self.query(queryText)
+        try:
+            while True:
+                cardInfo = await loop.run_in_executor(executor, next, results, self.__QUERY_FINISHED)
+                if cardInfo is self.__QUERY_FINISHED:
+                    break
+                yield cardInfo
+        finally:
+            results.close()
 
     def _getPageCount(self, html):
         return 1
@@ -171,6 +313,9 @@ class CardSource(object):
     def _parseResponse(self, queryText, url, html):
         yield None
 
+    def _parseEntry(self, queryText, url, entry):
+        yield None
+
     def _searchPreloaded(self, queryText):
         return []
 
@@ -181,8 +326,11 @@ class CardSource(object):
 
 
 class AngryBottleGnome(CardSource):
+    URL = 'http://angrybottlegnome.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://angrybottlegnome.ru', '/shop/search/{query}/filter/instock', setMap={'Promo - Special': 'Media Inserts'})
+        super().__init__(logger, self.URL, '/shop/search/{query}/filter/instock', setMap={'Promo - Special': 'Media Inserts'})
+        self.cacheRawResponses = True
         # <div class = "abg-float-left abg-card-margin abg-card-version-instock">Английский, M/NM  (30р., в наличии: 1)</div>
         # <div class = "abg-float-left abg-card-margin abg-card-version-instock">Итальянский, M/NM  Фойл (180р., в наличии: 1)</div>
         self.cardInfoRegexp = re.compile(r'(?P<language>[^,]+),\s*(?P<condition>[\S]+)\s*(?P<foilness>[^(]+)?\s*\((?P<price>\d+)[^\d]*(?P<count>\d+)\)')
@@ -192,17 +340,20 @@ class AngryBottleGnome(CardSource):
         return super().escapeQueryText(queryText.replace('R&D', '').replace('&', ''))
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('#search-results tbody tr'))
+        return len(self.select(html, '#search-results tbody tr'))
 
     def _parseResponse(self, queryText, url, html):
-        searchResults = html.cssselect('#search-results tbody tr')
-        for resultsEntry in searchResults:
-            dataCells = resultsEntry.cssselect('td')
-            cardName = dataCells[0].cssselect('a')[0].text
-            cardSet = dataCells[1].cssselect('a')[0].text
-            cardUrl = self.makeAbsUrl(dataCells[0].cssselect('a')[0].attrib['href'])
-            cardVersionsHtml = self.getHtml(cardUrl)
-            cardVersions = cardVersionsHtml.cssselect('.abg-card-version-instock')
+        searchResults = []
+        for resultsEntry in self.select(html, '#search-results tbody tr'):
+            dataCells = self.select(resultsEntry, 'td')
+            cardName = self.select(dataCells[0], 'a')[0].text
+            cardSet = self.select(dataCells[1], 'a')[0].text
+            cardUrl = self.makeAbsUrl(self.select(dataCells[0], 'a')[0].attrib['href'])
+            searchResults.append((cardName, cardSet, cardUrl))
+
+        for resultIndex, cardVersionsHtml in self.getHtmlPages([cardUrl for _, _, cardUrl in searchResults]):
+            cardName, cardSet, cardUrl = searchResults[resultIndex]
+            cardVersions = self.select(cardVersionsHtml, '.abg-card-version-instock')
             if len(cardVersions) > 0:
                 self.estimatedCardsCount += len(cardVersions) - 1  # одну карту уже учли выше
             for cardVersion in cardVersions:
@@ -224,29 +375,27 @@ class MtgRuShop(CardSource):
     def __init__(self, logger: ILogger, url: str, promoUrl: str):
         super().__init__(logger, url, '/catalog.phtml?Title={query}&page={page}', 'cp1251', 'cp1251', MtgRu.SPECIFIC_SETS)
         self.promoUrl = promoUrl
-        if self.promoUrl is not None:
-            self.promoHtml = self.getHtml(self.makeAbsUrl(self.promoUrl))
         self.entrySelector = '#Catalog tr'
 
     def _getPageCount(self, html):
         pagesCount = 1
-        pagesLinks = html.cssselect('.split-pages a')
+        pagesLinks = self.select(html, '.split-pages a')
         if len(pagesLinks) > 0:
             pagesCount = int(re.match(r'.+page=(\d+).*', pagesLinks[-1].attrib['href']).group(1))
         return pagesCount
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect(self.entrySelector))
+        return len(self.select(html, self.entrySelector))
 
     def _parseResponse(self, queryText, url, html):
-        for resultsEntry in html.cssselect(self.entrySelector):
-            dataCells = resultsEntry.cssselect('td')
-            langImage = os.path.basename(urllib.parse.urlparse(dataCells[1].cssselect('img')[0].attrib['src']).path)
+        for resultsEntry in self.select(html, self.entrySelector):
+            dataCells = self.select(resultsEntry, 'td')
+            langImage = os.path.basename(urllib.parse.urlparse(self.select(dataCells[1], 'img')[0].attrib['src']).path)
             language = self.langOracle.get_abbreviation(os.path.splitext(langImage)[0])
             nameSelector = 'span.CardName' if language == 'EN' else 'span.Zebra'
             yield {
-                'name': dataCells[2].cssselect(nameSelector)[0].text,
-                'set': dataCells[0].cssselect('img')[0].attrib['alt'],
+                'name': self.select(dataCells[2], nameSelector)[0].text,
+                'set': self.select(dataCells[0], 'img')[0].attrib['alt'],
                 'language': language,
                 'foilness': bool(dataCells[3].text),
                 'count': int(re.match(r'(\d+)', dataCells[5].text).group(0)),
@@ -257,8 +406,10 @@ class MtgRuShop(CardSource):
 
 
 class ManaPoint(MtgRuShop):
+    URL = 'http://manapoint.mtg.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://manapoint.mtg.ru', '2.html')
+        super().__init__(logger, self.URL, '2.html')
         # TODO move to json
         self.promoSetsSubstrings = {
             ('release', 'launch',): 'Prerelease & Release Cards',
@@ -268,12 +419,12 @@ class ManaPoint(MtgRuShop):
         }
 
     def _searchPreloaded(self, queryText):
-        if self.promoHtml is None:
+        if self.promoUrl is None:
             return []
 
         results = []
-        for resultsEntry in self.promoHtml.cssselect('table.Catalog tr'):
-            dataCells = resultsEntry.cssselect('td')
+        for resultsEntry in self.select(self.getHtml(self.promoUrl), 'table.Catalog tr'):
+            dataCells = self.select(resultsEntry, 'td')
             cardString = dataCells[0].text
 
             cardInfo = re.match(r'^(\[.+?])?(?P<name>[^\[(]+)\s*(\((?P<lang>[^)]+)\))?.+$', cardString).groupdict()
@@ -321,47 +472,49 @@ class ManaPoint(MtgRuShop):
 
 
 class MtgSale(CardSource):
+    URL = 'https://mtgsale.ru'
+
     def __init__(self, logger: ILogger):
         sourceSpecificSets = {
             'MI': 'Mirrodin',
             'MR': 'Mirage',
             'TP': 'Tempest',
         }
-        super().__init__(logger, 'https://mtgsale.ru', '/home/search-results?Name={query}&Page={page}', setMap=sourceSpecificSets)
+        super().__init__(logger, self.URL, '/home/search-results?Name={query}&Page={page}', setMap=sourceSpecificSets)
         self.verifySsl = False
 
     def _getPageCount(self, html):
         pagesCount = 1
-        pagesLinks = html.cssselect('ul.tabsb li a')
+        pagesLinks = self.select(html, 'ul.tabsb li a')
         if len(pagesLinks) > 0:
             pagesCount = int(pagesLinks[-1].text)
         return pagesCount
 
     def _getTotalCardsCount(self, html):
-        return int(re.match(r'\D*(\d+)\D*', html.cssselect('span.search-number')[0].text).group(1))
+        return int(re.match(r'\D*(\d+)\D*', self.select(html, 'span.search-number')[0].text).group(1))
 
     def _getPageCardsCount(self, html):
         return 25
 
     def _parseResponse(self, queryText, url, html):
-        for resultsEntry in html.cssselect('.tab_container div.ctclass'):
-            count = int(re.match(r'(\d+)', resultsEntry.cssselect('p.colvo')[0].text).group(0))
+        for resultsEntry in self.select(html, '.tab_container div.ctclass'):
+            count = int(re.match(r'(\d+)', self.select(resultsEntry, 'p.colvo')[0].text).group(0))
             if count <= 0:
                 yield None
                 continue
 
             nameSelector = 'p.tname .tnamec'
-            language = self.langOracle.get_abbreviation(resultsEntry.cssselect('p.lang i')[0].attrib['title'])
+            language = self.langOracle.get_abbreviation(self.select(resultsEntry, 'p.lang i')[0].attrib['title'])
             if language is not None and language != 'EN':
                 nameSelector = 'p.tname .smallfont'
 
-            entrySet = resultsEntry.cssselect('p.nabor span')[0].attrib['title']
+            entrySet = self.select(resultsEntry, 'p.nabor span')[0].attrib['title']
             if not (language or entrySet):
                 yield None
                 continue
 
-            priceString = resultsEntry.cssselect('p.pprice')[0].text
-            discountPriceBlocks = resultsEntry.cssselect('p.pprice .discount_price')
+            priceString = self.select(resultsEntry, 'p.pprice')[0].text
+            discountPriceBlocks = self.select(resultsEntry, 'p.pprice .discount_price')
             if len(discountPriceBlocks) > 0:
                 priceString = discountPriceBlocks[0].text
             price = None
@@ -369,11 +522,11 @@ class MtgSale(CardSource):
                 price = decimal.Decimal(re.match(r'(\d+)', priceString.strip()).group(0))
 
             yield {
-                'name': resultsEntry.cssselect(nameSelector)[0].text,
+                'name': self.select(resultsEntry, nameSelector)[0].text,
                 'set': entrySet,
                 'language': language,
-                'condition': resultsEntry.cssselect('p.sost span')[0].text,
-                'foilness': bool(resultsEntry.cssselect('p.foil')[0].text),
+                'condition': self.select(resultsEntry, 'p.sost span')[0].text,
+                'foilness': bool(self.select(resultsEntry, 'p.foil')[0].text),
                 'count': count,
                 'price': price,
                 'currency': core.utils.Currency.RUR,
@@ -382,17 +535,19 @@ class MtgSale(CardSource):
 
 
 class CardPlace(CardSource):
+    URL = 'http://cardplace.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://cardplace.ru', '/directory/new_search/{query}/singlemtg', queryEncoding='cp1251', setMap={'DCI Legends': 'Media Inserts'})
+        super().__init__(logger, self.URL, '/directory/new_search/{query}/singlemtg', queryEncoding='cp1251', setMap={'DCI Legends': 'Media Inserts'})
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('#mtgksingles tbody tr'))
+        return len(self.select(html, '#mtgksingles tbody tr'))
 
     def _parseResponse(self, queryText, url, html):
-        for resultsEntry in html.cssselect('#mtgksingles tbody tr'):
+        for resultsEntry in self.select(html, '#mtgksingles tbody tr'):
 
             cardCount = 0
-            countBlocks = resultsEntry.cssselect('td.t_s_count ul.count_cart_list li')
+            countBlocks = self.select(resultsEntry, 'td.t_s_count ul.count_cart_list li')
             if len(countBlocks) > 0:
                 cardCount = int(countBlocks[-1].text)
 
@@ -401,11 +556,11 @@ class CardPlace(CardSource):
                 continue
 
             cardLanguage = None
-            languageBlocks = resultsEntry.cssselect('td.t_s_flag img')
+            languageBlocks = self.select(resultsEntry, 'td.t_s_flag img')
             if len(languageBlocks) > 0:
                 cardLanguage = languageBlocks[0].attrib['title']
 
-            cardNameAnchors = resultsEntry.cssselect('td.t_s_name a')
+            cardNameAnchors = self.select(resultsEntry, 'td.t_s_name a')
             secondaryNameString, primaryNameString = self.extractToken(r'\s?\((?P<token>[^\)]+)\)', cardNameAnchors[0].text)
             cardName = primaryNameString
             if cardLanguage != 'Английский' and secondaryNameString is not None:
@@ -417,15 +572,15 @@ class CardPlace(CardSource):
                 if 'condition_guide' in conditionAnchor.attrib['href']:
                     cardCondition = conditionAnchor.text
 
-            cardNameImages = resultsEntry.cssselect('td.t_s_name img')
+            cardNameImages = self.select(resultsEntry, 'td.t_s_name img')
 
             yield {
                 'name': cardName,
                 'foilness': len(cardNameImages) > 0 and cardNameImages[0].attrib['title'].lower() == 'foil',
-                'set': resultsEntry.cssselect('td.t_s_edition')[0].text_content(),
+                'set': self.select(resultsEntry, 'td.t_s_edition')[0].text_content(),
                 'language': cardLanguage,
                 'condition': cardCondition,
-                'price': decimal.Decimal(resultsEntry.cssselect('td.t_s_price input')[0].attrib['value']),
+                'price': decimal.Decimal(self.select(resultsEntry, 'td.t_s_price input')[0].attrib['value']),
                 'currency': core.utils.Currency.RUR,
                 'count': cardCount,
                 'source': cardNameAnchors[0].attrib['href'],
@@ -433,6 +588,7 @@ class CardPlace(CardSource):
 
 
 class MtgRu(CardSource):
+    URL = 'http://mtg.ru'
     SPECIFIC_SETS = {
         'AN': 'Arabian Nights',
         'AQ': 'Antiquities',
@@ -455,76 +611,85 @@ class MtgRu(CardSource):
             'mtgtrade.net',
             'myupkeep.ru',
         ]
-        super().__init__(logger, 'http://mtg.ru', '/exchange/card.phtml?Title={query}&Amount=1', 'cp1251', 'cp1251', self.SPECIFIC_SETS)
+        super().__init__(logger, self.URL, '/exchange/card.phtml?Title={query}&Amount=1', 'cp1251', 'cp1251', self.SPECIFIC_SETS)
+        self.responseCacheTtl = 5 * 60
+        # Exchange lists of popular cards are huge, so offers are emitted while the page is still being parsed
+        self.streamedEntry = ('table', 'NoteDivWidth')
 
     def escapeQueryText(self, queryText):
         return super().escapeQueryText(queryText)
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('table.NoteDivWidth'))
+        return len(self.select(html, 'table.NoteDivWidth'))
 
     def _parseResponse(self, queryText, url, html):
-        for userEntry in html.cssselect('table.NoteDivWidth'):
-            userInfo = userEntry.cssselect('tr table')[0]
-            nickname = userInfo.cssselect('tr th')[0].text
-            exchangeUrl = userInfo.cssselect('tr td')[-1].cssselect('a')[0].attrib['href']
-            if any(source in exchangeUrl.lower() for source in self.sourceSubstringsToExclude):
-                yield None
+        for userEntry in self.select(html, 'table.NoteDivWidth'):
+            yield from self._parseEntry(queryText, url, userEntry)
+
+    def _parseEntry(self, queryText, url, userEntry):
+        userInfo = self.select(userEntry, 'tr table')[0]
+        nickname = self.select(userInfo, 'tr th')[0].text
+        exchangeUrl = self.select(self.select(userInfo, 'tr td')[-1], 'a')[0].attrib['href']
+        if any(source in exchangeUrl.lower() for source in self.sourceSubstringsToExclude):
+            yield None
+        else:
+            shopFound = not exchangeUrl.endswith('.html')
+            if shopFound:
+                cardSource = exchangeUrl
+                self.logger.warning('Found new shop: %s', exchangeUrl)
             else:
-                shopFound = not exchangeUrl.endswith('.html')
-                if shopFound:
-                    cardSource = exchangeUrl
-                    self.logger.warning('Found new shop: %s', exchangeUrl)
-                else:
-                    cardSource = self.getTitle() + '/' + nickname
+                cardSource = self.getTitle() + '/' + nickname
 
-                userCards = userEntry.cssselect('table.CardInfo')
-                if len(userCards) > 0:
-                    self.estimatedCardsCount += len(userCards) - 1
+            userCards = self.select(userEntry, 'table.CardInfo')
+            if len(userCards) > 0:
+                self.estimatedCardsCount += len(userCards) - 1
 
-                for cardInfo in userCards:
-                    cardName = cardInfo.cssselect('th.txt0')[0].text
-                    cardUrl = exchangeUrl
-                    if not shopFound:
-                        cardUrl += '?Title={}'.format(cardName)
+            for cardInfo in userCards:
+                cardName = self.select(cardInfo, 'th.txt0')[0].text
+                cardUrl = exchangeUrl
+                if not shopFound:
+                    cardUrl += '?Title={}'.format(cardName)
 
-                    idSource = cardInfo.cssselect('nobr.txt0')[0].text
-                    cardId = int(re.match(r'[^\d]*(\d+)[^\d]*', idSource).group(1)) if idSource else None
+                idSource = self.select(cardInfo, 'nobr.txt0')[0].text
+                cardId = int(re.match(r'[^\d]*(\d+)[^\d]*', idSource).group(1)) if idSource else None
 
-                    price = None
-                    priceSource = cardInfo.cssselect('td.txt15')[-1].cssselect('b')
-                    if len(priceSource) > 0:
-                        possiblePrice = priceSource[-1].text
-                        if possiblePrice is not None:
-                            possiblePrice = possiblePrice.split()[0]
-                            if possiblePrice.isdigit():
-                                price = decimal.Decimal(possiblePrice)
+                price = None
+                priceSource = self.select(self.select(cardInfo, 'td.txt15')[-1], 'b')
+                if len(priceSource) > 0:
+                    possiblePrice = priceSource[-1].text
+                    if possiblePrice is not None:
+                        possiblePrice = possiblePrice.split()[0]
+                        if possiblePrice.isdigit():
+                            price = decimal.Decimal(possiblePrice)
 
-                    foilness = len(cardInfo.cssselect('#FoilCard')) > 0
+                foilness = len(self.select(cardInfo, '#FoilCard')) > 0
 
-                    language = None
-                    languageSource = cardInfo.cssselect('td.txt15')[0].cssselect('font')
-                    if len(languageSource) > 0:
-                        language = languageSource[0].text
+                language = None
+                languageSource = self.select(self.select(cardInfo, 'td.txt15')[0], 'font')
+                if len(languageSource) > 0:
+                    language = languageSource[0].text
 
-                    setSource = cardInfo.cssselect('#table0 td img')[0].attrib['alt']
+                setSource = self.select(cardInfo, '#table0 td img')[0].attrib['alt']
 
-                    yield {
-                        'id': cardId,
-                        'name': cardName,
-                        'foilness': foilness,
-                        'set': setSource,
-                        'language': language,
-                        'price': price,
-                        'currency': core.utils.Currency.RUR,
-                        'count': int(cardInfo.cssselect('td.txt15 b')[0].text.split()[0]),
-                        'source': self.packSource(cardSource, cardUrl),
-                    }
+                yield {
+                    'id': cardId,
+                    'name': cardName,
+                    'foilness': foilness,
+                    'set': setSource,
+                    'language': language,
+                    'price': price,
+                    'currency': core.utils.Currency.RUR,
+                    'count': int(self.select(cardInfo, 'td.txt15 b')[0].text.split()[0]),
+                    'source': self.packSource(cardSource, cardUrl),
+                }
 
 
 class TopTrade(CardSource):
+    URL = 'https://topdeck.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'https://topdeck.ru', '/apps/toptrade/singles/search?q={query}')
+        super().__init__(logger, self.URL, '/apps/toptrade/singles/search?q={query}')
+        self.responseCacheTtl = 5 * 60
         self.excludedSellers = {
             'angrybottlegnome',
             'autumnsmagic.com',
@@ -544,7 +709,7 @@ class TopTrade(CardSource):
     def _extractResults(self, html):
         if self.searchResults is None:
             result = []
-            script = html.cssselect('script')[-1]
+            script = self.select(html, 'script')[-1]
             match = re.search(r'JSON.parse\("(.+)"\)', script.text_content())
             if match:
                 jsonString = match.group(1)
@@ -645,34 +810,34 @@ class MtgTradeShop(CardSource):
         return result
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect(self.cardSelector))
+        return len(self.select(html, self.cardSelector))
 
     def _parseResponse(self, queryText, url, html):
-        for resultsEntry in html.cssselect('.search-item'):
-            anchor = resultsEntry.cssselect('.search-title')[0]
+        for resultsEntry in self.select(html, '.search-item'):
+            anchor = self.select(resultsEntry, '.search-title')[0]
             isSingle = '/single/' in anchor.attrib['href']
 
             isToken = False
-            for p in resultsEntry.cssselect('p'):
+            for p in self.select(resultsEntry, 'p'):
                 if 'Token' in p.text:
                     isToken = True
                     break
 
             if not isSingle or isToken:
-                yield len(resultsEntry.cssselect(self.cardSelector))
+                yield len(self.select(resultsEntry, self.cardSelector))
                 continue
 
-            for cardsGroup in resultsEntry.cssselect('table.search-card'):
-                sellerBlock = cardsGroup.cssselect('td.user-name-td')[0]
+            for cardsGroup in self.select(resultsEntry, 'table.search-card'):
+                sellerBlock = self.select(cardsGroup, 'td.user-name-td')[0]
 
                 sellerNickname = None
-                sellerNameBlocks = sellerBlock.cssselect('div.trader-name')
+                sellerNameBlocks = self.select(sellerBlock, 'div.trader-name')
                 if len(sellerNameBlocks) > 0:
                     sellerNickname = sellerNameBlocks[0].text.strip()
                 if not sellerNickname:
-                    sellerNickname = sellerBlock.cssselect('a')[0].text
+                    sellerNickname = self.select(sellerBlock, 'a')[0].text
 
-                cardEntries = cardsGroup.cssselect('tbody tr')
+                cardEntries = self.select(cardsGroup, 'tbody tr')
                 if any(source in sellerNickname.lower() for source in self.sourceSubstringsToExclude):
                     yield len(cardEntries)
                     continue
@@ -683,85 +848,95 @@ class MtgTradeShop(CardSource):
 
                 for cardEntry in cardEntries:
                     condition = None
-                    conditionBlocks = cardEntry.cssselect('.js-card-quality-tooltip')
+                    conditionBlocks = self.select(cardEntry, '.js-card-quality-tooltip')
                     if len(conditionBlocks) > 0:
                         condition = conditionBlocks[0].text
 
                     language = None
-                    languageBlocks = cardEntry.cssselect('.lang-item-info')
+                    languageBlocks = self.select(cardEntry, '.lang-item-info')
                     if len(languageBlocks) > 0:
                         language = languageBlocks[0].attrib['title']
 
-                    cardSet = cardEntry.cssselect('.choose-set')[0].attrib['title']
+                    cardSet = self.select(cardEntry, '.choose-set')[0].attrib['title']
                     if 'mtgo' in cardSet.lower():
                         yield None
                         continue
 
                     yield {
                         'name': ' '.join(anchor.text_content().split()),
-                        'foilness': len(cardEntry.cssselect('img.foil')) > 0,
+                        'foilness': len(self.select(cardEntry, 'img.foil')) > 0,
                         'set': cardSet,
                         'language': language,
-                        'price': decimal.Decimal(''.join(cardEntry.cssselect('.catalog-rate-price b')[0].text.split()).strip('" ')),
+                        'price': decimal.Decimal(''.join(self.select(cardEntry, '.catalog-rate-price b')[0].text.split()).strip('" ')),
                         'currency': core.utils.Currency.RUR,
-                        'count': int(cardEntry.cssselect('td .sale-count')[0].text.strip()),
+                        'count': int(self.select(cardEntry, 'td .sale-count')[0].text.strip()),
                         'condition': condition,
                         'source': self.packSource(sourceCaption, anchor.attrib['href']),  # TODO specify url to specific player + card
                     }
 
 
 class MtgTrade(MtgTradeShop):
+    URL = 'http://mtgtrade.net'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://mtgtrade.net', ['bigmagic', 'upkeep', 'mtgshop', 'magiccardmarket'])
+        super().__init__(logger, self.URL, ['bigmagic', 'upkeep', 'mtgshop', 'magiccardmarket'])
 
 
 class BigMagic(MtgTradeShop):
+    URL = 'http://bigmagic.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://bigmagic.ru', [])
+        super().__init__(logger, self.URL, [])
 
 
 class MyUpKeep(MtgTradeShop):
+    URL = 'http://myupkeep.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://myupkeep.ru', [])
+        super().__init__(logger, self.URL, [])
 
 
 class MtgShopRu(MtgTradeShop):
+    URL = 'http://mtgshop.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://mtgshop.ru', [])
+        super().__init__(logger, self.URL, [])
 
 
 class AutumnsMagic(CardSource):
+    URL = 'http://autumnsmagic.com'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://autumnsmagic.com', '/catalog?search={query}&page={page}')
+        super().__init__(logger, self.URL, '/catalog?search={query}&page={page}')
 
     def _getPageCount(self, html):
         result = 1
-        pagesElements = html.cssselect('.allPages')
+        pagesElements = self.select(html, '.allPages')
         if pagesElements:
             result = int(pagesElements[-1].text_content().split()[-1].strip())
         return result
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('.product-wrapper'))
+        return len(self.select(html, '.product-wrapper'))
 
     def _parseResponse(self, queryText, url, html):
-        for entry in html.cssselect('.product-wrapper'):
-            cardUrl = entry.cssselect('a')[0].attrib['href']
+        for entry in self.select(html, '.product-wrapper'):
+            cardUrl = self.select(entry, 'a')[0].attrib['href']
             if any((c not in string.printable) for c in cardUrl):
                 yield None
                 continue
 
-            nameTags = entry.cssselect('.card-name')
+            nameTags = self.select(entry, '.card-name')
             if len(nameTags) == 0:
                 yield None
                 continue
-            cardName = nameTags[0].cssselect('a')[0].text.strip()
+            cardName = self.select(nameTags[0], 'a')[0].text.strip()
             if self._isCardUnrelated(cardName, queryText):
                 yield None
                 continue
 
-            dscBlock = entry.cssselect('.product-description')[0]
-            dscImages = dscBlock.cssselect('img')
+            dscBlock = self.select(entry, '.product-description')[0]
+            dscImages = self.select(dscBlock, 'img')
 
             language = None
             lngTitles = [img.attrib['title'] for img in dscImages if 'flags' in img.attrib['src']]
@@ -773,12 +948,12 @@ class AutumnsMagic(CardSource):
             foilString, cardName = self.extractToken(r'(?P<token>\s?\(фойловая\))', cardName)
             foil = foilString is not None
 
-            countTag = [tag for tag in dscBlock.cssselect('span') if 'шт' in tag.text][0]
-            priceTag = entry.cssselect('.product-footer .product-price .product-default-price')[0]
+            countTag = [tag for tag in self.select(dscBlock, 'span') if 'шт' in tag.text][0]
+            priceTag = self.select(entry, '.product-footer .product-price .product-default-price')[0]
 
             yield {
                 'name': cardName,
-                'set': dscBlock.cssselect('i')[0].attrib['class'].split()[1][len('ss-'):],
+                'set': self.select(dscBlock, 'i')[0].attrib['class'].split()[1][len('ss-'):],
                 'language': language,
                 'foilness': foil or len([img for img in dscImages if 'foil' in img.attrib['src']]) > 0,
                 'count': int(re.match(r'^([\d]+).*', countTag.text.replace(' ', '')).group(1)),
@@ -789,20 +964,21 @@ class AutumnsMagic(CardSource):
 
 
 class BuyMagic(CardSource):
+    URL = 'http://www.buymagic.com.ua'
     __PRODUCT_SELECTOR = 'input[value="Купить"]'
 
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://www.buymagic.com.ua', '/edition/?color=-1&type=-1&rare=-1&id=-1&name={query}&page={page}&submit=%s' % urllib.parse.quote('Искать'))
+        super().__init__(logger, self.URL, '/edition/?color=-1&type=-1&rare=-1&id=-1&name={query}&page={page}&submit=%s' % urllib.parse.quote('Искать'))
 
     def _getPageCount(self, html):
         result = 1
-        anchors = html.cssselect('div.c2 div table div a')
+        anchors = self.select(html, 'div.c2 div table div a')
         if len(anchors) > 0:
             result = int(anchors[-1].text)
         return result
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect(self.__PRODUCT_SELECTOR))
+        return len(self.select(html, self.__PRODUCT_SELECTOR))
 
     def _parseDoubleName(self, nameString: str) -> Tuple[str, Optional[str], Optional[str]]:
         n1, n2 = re.match(r'^([^(]+)?(?:\((.+)\))?', nameString).groups()
@@ -820,15 +996,15 @@ class BuyMagic(CardSource):
 
     def _parseResponse(self, queryText, url, html):
         blocks = {}
-        for image in html.cssselect('a.single_image'):
+        for image in self.select(html, 'a.single_image'):
             block = list(image.iterancestors())[0]
             blocks[id(block)] = block
         for block in blocks.values():
-            numProducts = len(block.cssselect(self.__PRODUCT_SELECTOR))
+            numProducts = len(self.select(block, self.__PRODUCT_SELECTOR))
             if 'Тип карты' not in block.text_content():
                 yield numProducts
                 continue
-            anchor = block.cssselect('a.link_card_name')[0]
+            anchor = self.select(block, 'a.link_card_name')[0]
             cardName, blockSet = [s for s in anchor.text_content().split('\t') if s.strip()]
             if any(s in cardName.lower() for s in ['token', 'emblem']):
                 yield numProducts
@@ -836,7 +1012,7 @@ class BuyMagic(CardSource):
             cardName, langFromName, comment = self._parseDoubleName(cardName)
             setIsRus, blockSet = self.extractToken(r'(?P<token>\sРУС)', blockSet)
             blockSet = re.match(r'^\[(.+?)]$', blockSet).group(1)
-            for entry in block.cssselect('table tr'):
+            for entry in self.select(block, 'table tr'):
                 text = entry.text_content()
                 cardSet = blockSet
                 langFromSet = self.langOracle.get_abbreviation(cardSet, quiet=True)
@@ -856,42 +1032,44 @@ class BuyMagic(CardSource):
                     'language': language,
                     'price': decimal.Decimal(re.search(r'([\d.]+) грн\.', text).group(1)),
                     'currency': core.utils.Currency.UAH,
-                    'count': int(entry.cssselect('select[name="card_count"] option')[-1].text),
+                    'count': int(self.select(entry, 'select[name="card_count"] option')[-1].text),
                     'source': anchor.attrib['href'],
                 }
 
 
 class MyMagic(CardSource):
+    URL = 'http://mymagic.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://mymagic.ru', '/collection/card-search/filter/clear/apply/?qr={query}&PAGEN_2={page}')
+        super().__init__(logger, self.URL, '/collection/card-search/filter/clear/apply/?qr={query}&PAGEN_2={page}')
 
     def _getPageCount(self, html):
         result = 1
-        anchors = html.cssselect('a.PageButton')
+        anchors = self.select(html, 'a.PageButton')
         if len(anchors) > 0:
             result = int(anchors[-1].text)
         return result
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('.SingleListItem'))
+        return len(self.select(html, '.SingleListItem'))
 
     def _parseResponse(self, queryText, url, html):
-        for entry in html.cssselect('.SingleListItem'):
-            priceBlock = entry.cssselect('.price-column')[0]
-            stocks = priceBlock.cssselect('.stock .count')
+        for entry in self.select(html, '.SingleListItem'):
+            priceBlock = self.select(entry, '.price-column')[0]
+            stocks = self.select(priceBlock, '.stock .count')
             if len(stocks) == 0:
                 yield None
                 continue
 
-            anchor = entry.cssselect('.name-column a')[0]
+            anchor = self.select(entry, '.name-column a')[0]
             foilnessString, cardName = self.extractToken(r'\s*(?P<token>Foil)', anchor.text)
 
             yield {
                 'name': cardName,
                 'foilness': foilnessString is not None,
-                'set': entry.cssselect('.set-column')[0].text,
+                'set': self.select(entry, '.set-column')[0].text,
                 'language': LangUtils.guess_language(cardName),
-                'price': decimal.Decimal(re.sub(r'\D+', '', priceBlock.cssselect('.price .current span')[0].text_content())),
+                'price': decimal.Decimal(re.sub(r'\D+', '', self.select(priceBlock, '.price .current span')[0].text_content())),
                 'currency': core.utils.Currency.RUR,
                 'count': int(re.match(r'(\d+)', stocks[0].text.strip()).group(1)),
                 'source': anchor.attrib['href'],
@@ -899,29 +1077,34 @@ class MyMagic(CardSource):
 
 
 class MtgSingles(CardSource):
+    URL = 'https://mtgsingles.ru'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'https://mtgsingles.ru', '/search/?search={query}&category_id=59')
+        super().__init__(logger, self.URL, '/search/?search={query}&category_id=59')
+        self.cacheRawResponses = True
 
     def _getPageCount(self, html):
         result = 1
-        anchors = html.cssselect('ul.pagination li a')
+        anchors = self.select(html, 'ul.pagination li a')
         if len(anchors) > 0:
             result = int(re.search(r'/page-(\d+)', anchors[-1].attrib['href']).group(1))
         return result
 
     def _getPageCardsCount(self, html):
-        return len(html.cssselect('div.products div.product-grid'))
+        return len(self.select(html, 'div.products div.product-grid'))
 
     def _parseResponse(self, queryText, url, html):
-        for entry in html.cssselect('div.products div.product-grid'):
-            cardNameAnchor = entry.cssselect('div.caption a')[0]
+        entries = self.select(html, 'div.products div.product-grid')
+        cardNameAnchors = [self.select(entry, 'div.caption a')[0] for entry in entries]
+        for entryIndex, cardPage in self.getHtmlPages([anchor.attrib['href'] for anchor in cardNameAnchors]):
+            entry = entries[entryIndex]
+            cardNameAnchor = cardNameAnchors[entryIndex]
             cardUrl = cardNameAnchor.attrib['href']
 
-            cardPage = self.getHtml(cardUrl)
             cardSet = None
             cardLanguage = None
-            for propertyRow in cardPage.cssselect('#tab-specification table tr'):
-                cells = propertyRow.cssselect('td')
+            for propertyRow in self.select(cardPage, '#tab-specification table tr'):
+                cells = self.select(propertyRow, 'td')
                 if len(cells) > 0:
                     if cells[0].text == 'Язык':
                         cardLanguage = cells[1].text
@@ -929,9 +1112,9 @@ class MtgSingles(CardSource):
                         cardSet = cells[1].text.replace(' (Foil)', '')
 
             cardCount = None
-            for div in cardPage.cssselect('.product-points div'):
+            for div in self.select(cardPage, '.product-points div'):
                 if 'stock' in div.attrib['class']:
-                    cardCountCandidate = div.cssselect('span')[-1].text.split()[-1]
+                    cardCountCandidate = self.select(div, 'span')[-1].text.split()[-1]
                     if cardCountCandidate.isdigit():
                         cardCount = int(cardCountCandidate)
             if cardCount is None:
@@ -943,7 +1126,7 @@ class MtgSingles(CardSource):
                 'foilness': 'foil' in cardUrl,
                 'set': cardSet,
                 'language': cardLanguage,
-                'price': decimal.Decimal(re.sub(r'[^\d.]+', '', entry.cssselect('span.price')[0].text).rstrip('.')),
+                'price': decimal.Decimal(re.sub(r'[^\d.]+', '', self.select(entry, 'span.price')[0].text).rstrip('.')),
                 'currency': core.utils.Currency.RUR,
                 'count': cardCount,
                 'source': cardUrl,
@@ -951,8 +1134,10 @@ class MtgSingles(CardSource):
 
 
 class OfflineTestSource(CardSource):
+    URL = 'http://offline.shop'
+
     def __init__(self, logger: ILogger):
-        super().__init__(logger, 'http://offline.shop', '?query={query}')
+        super().__init__(logger, self.URL, '?query={query}')
         self.setAbbreviations = list(load_json_resource('set_names.json').keys())
 
     def query(self, queryText):
@@ -960,19 +1145,16 @@ class OfflineTestSource(CardSource):
         for _ in range(self.estimatedCardsCount):
             if bool(random.randint(0, 1)):
                 time.sleep(random.randint(0, 1))
-            # noinspection PyProtectedMember
-            yield {
-                'id': random.randint(1, 300),
-                'name': random.choice(string.ascii_letters) * random.randint(10, 25),
-                'foilness': bool(random.randint(0, 1)),
-                'set': random.choice(self.setAbbreviations),
-                'language': random.choice(['RU', 'EN', 'FR', 'DE', 'ES']),
-                'price': decimal.Decimal(random.randint(10, 1000)) if bool(random.randint(0, 1)) else None,
-                'currency': random.choice([core.utils.Currency.RUR, core.utils.Currency.USD, core.utils.Currency.EUR]),
-                'count': random.randint(1, 10),
-                'condition': random.choice(['HP', 'NM', 'SP', 'MP']),
-                'source': '',
-            }
+            yield CardOffer(
+                offer_id=random.randint(1, 300),
+                caption=random.choice(string.ascii_letters) * random.randint(10, 25),
+                foilness=bool(random.randint(0, 1)),
+                set_id=random.choice(self.setAbbreviations),
+                language=random.choice(['RU', 'EN', 'FR', 'DE', 'ES']),
+                price=decimal.Decimal(random.randint(10, 1000)) if bool(random.randint(0, 1)) else None,
+                currency=random.choice([core.utils.Currency.RUR, core.utils.Currency.USD, core.utils.Currency.EUR]),
+                count=random.randint(1, 10),
+                condition=random.choice(['HP', 'NM', 'SP', 'MP']))
 
 
 def getCardSourceClasses():
@@ -0,0 +1,154 @@
+import contextlib
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterator, NamedTuple, Optional
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size_bytes: int
+
+
+class LruCache(object):
+    def __init__(self, max_size_bytes: int):
+        self.__max_size_bytes = max_size_bytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__size_bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size_bytes: int) -> None:
+        with self.__lock:
+            old_entry = self.__entries.pop(key, None)
+            if old_entry is not None:
+                self.__size_bytes -= old_entry[1]
+            if size_bytes > self.__max_size_bytes:
+                return
+            self.__entries[key] = (value, size_bytes)
+            self.__size_bytes += size_bytes
+            while self.__size_bytes > self.__max_size_bytes:
+                _, (_, evicted_size_bytes) = self.__entries.popitem(last=False)
+                self.__size_bytes -= evicted_size_bytes
+                self.__evictions += 1
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__size_bytes = 0
+
+    def get_stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(self.__hits, self.__misses, self.__evictions, len(self.__entries), self.__size_bytes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+
+class HttpResponseCache(object):
+    def __init__(self, path: str, max_size_bytes: int):
+        self.__path = path
+        self.__max_size_bytes = max_size_bytes
+        with self.__connect() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    @classmethod
+    def make_key(cls, method: str, url: str, body: Optional[bytes]) -> str:
+        digest = hashlib.sha1()
+        for part in (method.encode('utf-8'), url.encode('utf-8'), body or b''):
+            digest.update(part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self.__connect() as connection:
+            row = connection.execute('SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return CachedResponse(*row)
+
+    def put(self, key: str, body: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+        if len(body) > self.__max_size_bytes:
+            return
+        now = time.time()
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, body, etag, last_modified, stored_at, accessed_at, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(body), etag, last_modified, now, now, len(body)))
+            self.__evict(connection)
+
+    def refresh(self, key: str) -> None:
+        now = time.time()
+        with self.__connect() as connection:
+            connection.execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+
+    def get_size(self) -> int:
+        with self.__connect() as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def clear(self) -> None:
+        with self.__connect() as connection:
+            connection.execute('DELETE FROM responses')
+
+    @contextlib.contextmanager
+    def __connect(self) -> Iterator[sqlite3.Connection]:
+        # Connections are not shared, so the cache may be used from any thread of any process
+        connection = sqlite3.connect(self.__path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def __evict(self, connection: sqlite3.Connection) -> None:
+        excess = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0] - self.__max_size_bytes
+        if excess <= 0:
+            return
+        evicted_keys = []
+        for key, size in connection.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            evicted_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
@@ -1,92 +1,752 @@
 # coding: utf-8
 
+import contextlib
+import enum
 import errno
+import functools
 import http
 import http.client
-import io
+import json
+import os
+import random
+import socket
+import sqlite3
 import ssl
+import threading
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
-from typing import Optional
+import zipfile
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Google's brotli decompressor has process(), while brotlipy installed under the same module name has decompress()
+BROTLI_SUPPORTED = brotli is not None and any(hasattr(getattr(brotli, 'Decompressor', None), name) for name in ('process', 'decompress'))
+
+from core.cache import CachedResponse, HttpResponseCache
 from core.utils import ILogger
 
 MAX_ATTEMPTS = 30
-HTTP_DELAY_SECONDS_MULTIPLIER = 2
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 30
+RETRY_DEADLINE_SECONDS = 120
+ATTEMPT_TIMEOUT_SECONDS = 30
+HOST_RETRY_BUDGET = 10
+HOST_RETRY_BUDGET_REFILL_PER_SECOND = 0.2
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT_SECONDS = 60
 CHUNK_SIZE_BYTES = 1024 * 100
+FIXTURE_ARCHIVE_VERSION = 1
+ACCEPT_ENCODING = 'gzip, deflate, br' if BROTLI_SUPPORTED else 'gzip, deflate'
+CONNECTION_POOL_SIZE = 4
+CONNECTION_IDLE_TIMEOUT_SECONDS = 30
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.wots.http.db')
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HOST_REQUESTS_PER_SECOND = 5
+HOST_REQUESTS_BURST = 10
+HOST_MAX_CONCURRENT_REQUESTS = 4
+IP_GROUP_REQUESTS_PER_SECOND = 10
+IP_GROUP_REQUESTS_BURST = 20
+IP_GROUP_MAX_CONCURRENT_REQUESTS = 8
+
+
+class ConnectionPool(object):
+    def __init__(self, maxSize: int, idleTimeout: float):
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.__lock = threading.Lock()
+        self.__idleConnections = {}
+
+    def acquire(self, key: tuple) -> Optional[http.client.HTTPConnection]:
+        expiredConnections = []
+        result = None
+        with self.__lock:
+            connections = self.__idleConnections.get(key, [])
+            while connections and result is None:
+                connection, releaseTime = connections.pop()
+                if time.monotonic() - releaseTime < self.idleTimeout:
+                    result = connection
+                else:
+                    expiredConnections.append(connection)
+        for connection in expiredConnections:
+            connection.close()
+        return result
+
+    def release(self, key: tuple, connection: http.client.HTTPConnection) -> None:
+        with self.__lock:
+            connections = self.__idleConnections.setdefault(key, [])
+            if len(connections) < self.maxSize:
+                connections.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def clear(self) -> None:
+        with self.__lock:
+            idleConnections, self.__idleConnections = self.__idleConnections, {}
+        for connections in idleConnections.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+CONNECTION_POOL = ConnectionPool(CONNECTION_POOL_SIZE, CONNECTION_IDLE_TIMEOUT_SECONDS)
+
+
+def configureConnectionPool(maxSize: int, idleTimeout: float) -> None:
+    CONNECTION_POOL.clear()
+    CONNECTION_POOL.maxSize = maxSize
+    CONNECTION_POOL.idleTimeout = idleTimeout
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    releaseConnection = None
+
+    def close(self):
+        # Connection may be reused only if the whole body has been read out of it
+        reusable = self.isclosed() and not self.will_close
+        super().close()
+        release, self.releaseConnection = self.releaseConnection, None
+        if release is not None:
+            release(reusable)
+
+
+class _KeepAliveHandlerMixin(object):
+    def _openPooled(self, verifySsl: bool, connectionClass, request: urllib.request.Request, **connectionArgs):
+        host = request.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        headers = dict(request.unredirected_hdrs)
+        headers.update({k: v for k, v in request.headers.items() if k not in headers})
+        headers = {name.title(): value for name, value in headers.items()}
+
+        # noinspection PyProtectedMember
+        tunnelHost = request._tunnel_host
+        key = (request.type, host, tunnelHost, verifySsl)
+        connection = CONNECTION_POOL.acquire(key)
+        reused = connection is not None
+        if reused:
+            # Pooled connection still has timeout of the request that has opened it
+            connection.timeout = request.timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(request.timeout)
+        while True:
+            if connection is None:
+                connection = connectionClass(host, timeout=request.timeout, **connectionArgs)
+                connection.response_class = _PooledResponse
+                if tunnelHost:
+                    connection.set_tunnel(tunnelHost)
+            try:
+                try:
+                    connection.request(request.get_method(), request.selector, request.data, headers)
+                except OSError as ex:
+                    raise urllib.error.URLError(ex)
+                response = connection.getresponse()
+            except (urllib.error.URLError, http.client.HTTPException, ConnectionError):
+                connection.close()
+                if reused:
+                    # Server has dropped idle keep-alive connection, try again with a fresh one
+                    reused = False
+                    connection = None
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            break
+
+        def releaseConnection(reusable: bool) -> None:
+            if reusable:
+                CONNECTION_POOL.release(key, connection)
+            else:
+                connection.close()
+
+        response.releaseConnection = releaseConnection
+        response.url = request.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+class KeepAliveHTTPHandler(_KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self._openPooled(True, http.client.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+    __CONTEXTS = {}
+
+    def __init__(self, verifySsl: bool):
+        super().__init__(context=self.__getContext(verifySsl))
+        self.verifySsl = verifySsl
+
+    @classmethod
+    def __getContext(cls, verifySsl: bool) -> Optional[ssl.SSLContext]:
+        if verifySsl:
+            return None
+        if verifySsl not in cls.__CONTEXTS:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            # noinspection PyUnresolvedReferences
+            context.verify_mode = ssl.CERT_NONE
+            cls.__CONTEXTS[verifySsl] = context
+        return cls.__CONTEXTS[verifySsl]
+
+    def https_open(self, req):
+        # noinspection PyUnresolvedReferences
+        return self._openPooled(self.verifySsl, http.client.HTTPSConnection, req, context=self._context)
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updateTime = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes a token, possibly in debt, and returns how many seconds caller has to wait before using it
+        self.__refill()
+        self.__tokens -= 1
+        return max(0.0, -self.__tokens / self.rate)
+
+    def tryTake(self) -> bool:
+        self.__refill()
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updateTime) * self.rate)
+        self.__updateTime = now
+
+
+class RequestScheduler(object):
+    def __init__(self, hostRate: float, hostBurst: float, hostConcurrency: int, groupRate: float, groupBurst: float, groupConcurrency: int):
+        self.__hostLimits = (hostRate, hostBurst, hostConcurrency)
+        self.__groupLimits = (groupRate, groupBurst, groupConcurrency)
+        self.__lock = threading.Lock()
+        self.__groupsByHost = {}
+        self.__buckets = {}
+        self.__semaphores = {}
+
+    @contextlib.contextmanager
+    def request(self, url: str) -> Iterator[None]:
+        host = urllib.parse.urlparse(url).hostname or ''
+        hostKey = ('host', host)
+        groupKey = ('ip', self.getGroup(host))
+        with self.__lock:
+            hostBucket, hostSemaphore = self.__getLimiters(hostKey, self.__hostLimits)
+            groupBucket, groupSemaphore = self.__getLimiters(groupKey, self.__groupLimits)
+        # Semaphores are always acquired in the same order, host goes first
+        with hostSemaphore, groupSemaphore:
+            with self.__lock:
+                delay = max(hostBucket.reserve(), groupBucket.reserve())
+            if delay > 0:
+                time.sleep(delay)
+            yield
+
+    def getGroup(self, host: str) -> str:
+        # Shops sharing hosting share IP address, so they share request budget as well
+        with self.__lock:
+            if host in self.__groupsByHost:
+                return self.__groupsByHost[host]
+        try:
+            group = socket.gethostbyname(host)
+        except (OSError, UnicodeError):
+            group = host
+        with self.__lock:
+            self.__groupsByHost[host] = group
+        return group
+
+    def __getLimiters(self, key: tuple, limits: tuple) -> tuple:
+        if key not in self.__buckets:
+            rate, burst, concurrency = limits
+            self.__buckets[key] = TokenBucket(rate, burst)
+            self.__semaphores[key] = threading.BoundedSemaphore(concurrency)
+        return self.__buckets[key], self.__semaphores[key]
+
+
+REQUEST_SCHEDULER = RequestScheduler(
+    HOST_REQUESTS_PER_SECOND, HOST_REQUESTS_BURST, HOST_MAX_CONCURRENT_REQUESTS,
+    IP_GROUP_REQUESTS_PER_SECOND, IP_GROUP_REQUESTS_BURST, IP_GROUP_MAX_CONCURRENT_REQUESTS)
+
+
+def configureRequestScheduler(hostRate: float, hostBurst: float, hostConcurrency: int, groupRate: float, groupBurst: float, groupConcurrency: int) -> None:
+    global REQUEST_SCHEDULER
+    REQUEST_SCHEDULER = RequestScheduler(hostRate, hostBurst, hostConcurrency, groupRate, groupBurst, groupConcurrency)
+
+
+class RetryPolicy(object):
+    def __init__(self, maxAttempts: int = MAX_ATTEMPTS, baseDelay: float = RETRY_BASE_DELAY_SECONDS, maxDelay: float = RETRY_MAX_DELAY_SECONDS,
+                 deadline: float = RETRY_DEADLINE_SECONDS, hostBudget: float = HOST_RETRY_BUDGET, hostBudgetRefillRate: float = HOST_RETRY_BUDGET_REFILL_PER_SECOND,
+                 attemptTimeout: float = ATTEMPT_TIMEOUT_SECONDS):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.deadline = deadline
+        self.attemptTimeout = attemptTimeout
+        self.hostBudget = hostBudget
+        self.hostBudgetRefillRate = hostBudgetRefillRate
+        self.__lock = threading.Lock()
+        self.__budgets = {}
+
+    def getDelay(self, attempt: int) -> float:
+        # Exponential backoff with full jitter, so that retries of concurrent requests do not come in waves
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+    def takeRetry(self, host: str) -> bool:
+        with self.__lock:
+            if host not in self.__budgets:
+                self.__budgets[host] = TokenBucket(self.hostBudgetRefillRate, self.hostBudget)
+            return self.__budgets[host].tryTake()
+
+
+@enum.unique
+class CircuitState(enum.Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    def __init__(self, failureThreshold: int, resetTimeout: float):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.__lock = threading.Lock()
+        self.__failures = {}
+        self.__openTimes = {}
+        # Host of a single request let through to a half-open circuit, mapped to the thread making it
+        self.__probingHosts = {}
+
+    def getState(self, host: str) -> CircuitState:
+        with self.__lock:
+            return self.__getState(host)
+
+    def allowRequest(self, host: str) -> bool:
+        with self.__lock:
+            state = self.__getState(host)
+            if state == CircuitState.CLOSED:
+                return True
+            if state == CircuitState.HALF_OPEN and host not in self.__probingHosts:
+                # Let a single request through to find out whether host is back
+                self.__probingHosts[host] = threading.get_ident()
+                return True
+            return False
+
+    def recordSuccess(self, host: str) -> None:
+        with self.__lock:
+            self.__failures.pop(host, None)
+            self.__openTimes.pop(host, None)
+            self.__probingHosts.pop(host, None)
+
+    def recordFailure(self, host: str) -> bool:
+        # Returns True if this failure has opened the circuit
+        with self.__lock:
+            wasProbing = self.__probingHosts.pop(host, None) is not None
+            self.__failures[host] = self.__failures.get(host, 0) + 1
+            if wasProbing or (host not in self.__openTimes and self.__failures[host] >= self.failureThreshold):
+                self.__openTimes[host] = time.monotonic()
+                return True
+            return False
+
+    def releaseProbe(self, host: str) -> None:
+        # Probe of the calling thread has ended without telling anything about host, so another one may be sent
+        with self.__lock:
+            if self.__probingHosts.get(host) == threading.get_ident():
+                del self.__probingHosts[host]
+
+    def __getState(self, host: str) -> CircuitState:
+        if host not in self.__openTimes:
+            return CircuitState.CLOSED
+        if time.monotonic() - self.__openTimes[host] < self.resetTimeout:
+            return CircuitState.OPEN
+        return CircuitState.HALF_OPEN
+
+
+class HostUnavailableError(urllib.error.URLError):
+    def __init__(self, host: str):
+        super().__init__('{} is unavailable'.format(host))
+        self.host = host
+
+
+class RequestCoalescer(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pendingResults = {}
+
+    def run(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        # Concurrent callers with the same key wait for the first one instead of doing the same work again
+        with self.__lock:
+            pendingResult = self.__pendingResults.get(key)
+            if pendingResult is None:
+                self.__pendingResults[key] = Future()
+        if pendingResult is not None:
+            return pendingResult.result()
+
+        pendingResult = self.__pendingResults[key]
+        try:
+            result = function()
+            pendingResult.set_result(result)
+            return result
+        except BaseException as ex:
+            pendingResult.set_exception(ex)
+            raise
+        finally:
+            with self.__lock:
+                del self.__pendingResults[key]
+
+
+class _DeflateDecoder(object):
+    def __init__(self):
+        self.__decompressor = zlib.decompressobj()
+        self.__started = False
+
+    def decompress(self, data: bytes) -> bytes:
+        if not self.__started:
+            self.__started = True
+            try:
+                return self.__decompressor.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate stream without zlib header
+                self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.__decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        return self.__decompressor.flush()
+
+
+class _BrotliDecoder(object):
+    def __init__(self):
+        decompressor = brotli.Decompressor()
+        self.__decompress = getattr(decompressor, 'process', None) or decompressor.decompress
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.__decompress(data)
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def createContentDecoder(contentEncoding: Optional[str]):
+    contentEncoding = (contentEncoding or '').strip().lower()
+    if contentEncoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if contentEncoding == 'deflate':
+        return _DeflateDecoder()
+    if contentEncoding == 'br' and BROTLI_SUPPORTED:
+        return _BrotliDecoder()
+    return None
+
+
+class TransferStats(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__statsByHost = {}
+
+    def add(self, host: str, wireBytes: int, decodedBytes: int) -> None:
+        with self.__lock:
+            requests, totalWireBytes, totalDecodedBytes = self.__statsByHost.get(host, (0, 0, 0))
+            self.__statsByHost[host] = (requests + 1, totalWireBytes + wireBytes, totalDecodedBytes + decodedBytes)
+
+    def get(self) -> Dict[str, Tuple[int, int, int]]:
+        # host -> (requests, bytes received, bytes after decoding)
+        with self.__lock:
+            return dict(self.__statsByHost)
+
+
+class FixtureMode(enum.Enum):
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+
+class FixtureMissingError(urllib.error.URLError):
+    def __init__(self, representation: str):
+        super().__init__('No recorded response for {}'.format(representation))
+
+
+class FixtureArchive(object):
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, path: str, mode: FixtureMode):
+        self.path = path
+        self.mode = mode
+        self.metadata = {}
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        if mode == FixtureMode.RECORD:
+            self.__archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.__archive = zipfile.ZipFile(path, 'r')
+            manifest = json.loads(self.__archive.read(self.MANIFEST_NAME).decode('utf-8'))
+            if manifest.get('version') != FIXTURE_ARCHIVE_VERSION:
+                self.__archive.close()
+                raise ValueError('Unsupported fixture archive version {} in {}'.format(manifest.get('version'), path))
+            self.metadata = manifest['metadata']
+            self.__entries = {entry['key']: entry for entry in manifest['entries']}
+
+    @staticmethod
+    def makeKey(method: str, url: str, parametersString: Optional[str]) -> str:
+        return HttpResponseCache.make_key(method, url, parametersString.encode('utf-8') if parametersString else None)
+
+    def load(self, method: str, url: str, parametersString: Optional[str]) -> Optional[bytes]:
+        with self.__lock:
+            entry = self.__entries.get(self.makeKey(method, url, parametersString))
+            if entry is None:
+                return None
+            return self.__archive.read(entry['file'])
+
+    def store(self, method: str, url: str, parametersString: Optional[str], body: bytes) -> None:
+        key = self.makeKey(method, url, parametersString)
+        with self.__lock:
+            if key in self.__entries:
+                return
+            fileName = 'responses/{}'.format(key)
+            self.__archive.writestr(fileName, body)
+            self.__entries[key] = {'key': key, 'method': method, 'url': url, 'parameters': parametersString, 'file': fileName, 'size': len(body)}
+
+    def getEntriesCount(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.mode == FixtureMode.RECORD:
+                manifest = {
+                    'version': FIXTURE_ARCHIVE_VERSION,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'metadata': self.metadata,
+                    'entries': sorted(self.__entries.values(), key=lambda entry: entry['url']),
+                }
+                self.__archive.writestr(self.MANIFEST_NAME, json.dumps(manifest, indent=2, sort_keys=True))
+            self.__archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+RETRY_POLICY = RetryPolicy()
+REQUEST_COALESCER = RequestCoalescer()
+TRANSFER_STATS = TransferStats()
+CIRCUIT_BREAKER = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT_SECONDS)
+
+
+_responseCachePath = RESPONSE_CACHE_PATH
+_responseCacheMaxBytes = RESPONSE_CACHE_MAX_BYTES
+_responseCache = None
+_responseCacheLock = threading.Lock()
+
+
+def configureResponseCache(path: Optional[str], maxSizeBytes: int = RESPONSE_CACHE_MAX_BYTES) -> None:
+    global _responseCachePath, _responseCacheMaxBytes, _responseCache
+    with _responseCacheLock:
+        _responseCachePath = path
+        _responseCacheMaxBytes = maxSizeBytes
+        _responseCache = None
+
+
+def getResponseCache() -> Optional[HttpResponseCache]:
+    global _responseCache
+    with _responseCacheLock:
+        if _responseCache is None and _responseCachePath is not None:
+            _responseCache = HttpResponseCache(_responseCachePath, _responseCacheMaxBytes)
+        return _responseCache
+
+
+_fixtureArchive = None
+
+
+def useFixtureArchive(archive: Optional[FixtureArchive]) -> None:
+    # While archive is in use, responses are either captured into it or served from it without touching network
+    global _fixtureArchive
+    _fixtureArchive = archive
+
 
 def httpCodeAnyOf(code, statuses):
-    for candidate, _, _ in statuses:
+    for candidate in statuses:
         if code == candidate:
             return True
     return False
 
-def getUrl(url: str, logger: ILogger, parametersDict: Optional[dict]=None, verbose: bool=False, verifySsl: bool=True):
+def getUrl(url: str, logger: ILogger, parametersDict: Optional[dict]=None, verbose: bool=False, verifySsl: bool=True, cacheTtl: Optional[float]=None,
+           retryPolicy: Optional[RetryPolicy]=None):
+    parametersString = urllib.parse.urlencode(parametersDict) if parametersDict else None
+    method = 'POST' if parametersString else 'GET'
+    fixtureArchive = _fixtureArchive
+    if fixtureArchive is not None and fixtureArchive.mode == FixtureMode.REPLAY:
+        body = fixtureArchive.load(method, url, parametersString)
+        if body is None:
+            raise FixtureMissingError('[{}] {}'.format(method, url))
+        return body
+
+    # Only calls that would send the same request and handle its failures the same way may share the result
+    retryPolicy = retryPolicy or RETRY_POLICY
+    body = REQUEST_COALESCER.run((url, parametersString, verifySsl, cacheTtl, retryPolicy, ACCEPT_ENCODING), functools.partial(
+        __loadUrl, url, logger, parametersString, verbose, verifySsl, cacheTtl, retryPolicy))
+    if fixtureArchive is not None:
+        fixtureArchive.store(method, url, parametersString, body)
+    return body
+
+
+def __loadUrl(url: str, logger: ILogger, parametersString: Optional[str], verbose: bool, verifySsl: bool, cacheTtl: Optional[float], retryPolicy: Optional[RetryPolicy]):
+    method = 'POST' if parametersString else 'GET'
     parametersBytes = None
-    representation = '[{}] {}'.format('POST' if parametersDict else 'GET', url)
-    if parametersDict:
-        parametersString = urllib.parse.urlencode(parametersDict)
+    representation = '[{}] {}'.format(method, url)
+    if parametersString:
         parametersBytes = parametersString.encode('utf-8')
         representation += '?{}'.format(parametersString)
 
+    cache = getResponseCache() if cacheTtl is not None else None
+    cacheKey = None
+    cachedResponse = None
+    requestHeaders = {'Accept-Encoding': ACCEPT_ENCODING}
+    if cache is not None:
+        cacheKey = cache.make_key(method, url, parametersBytes)
+        cachedResponse = __loadCachedResponse(cache, cacheKey, logger)
+        if cachedResponse is not None:
+            if time.time() - cachedResponse.stored_at < cacheTtl:
+                if verbose:
+                    logger.debug('Cached %s', representation)
+                return cachedResponse.body
+            if cachedResponse.etag:
+                requestHeaders['If-None-Match'] = cachedResponse.etag
+            if cachedResponse.last_modified:
+                requestHeaders['If-Modified-Since'] = cachedResponse.last_modified
+
+    retryPolicy = retryPolicy or RETRY_POLICY
+    host = urllib.parse.urlparse(url).hostname or ''
+    deadline = time.monotonic() + retryPolicy.deadline
     attempt = 0
     if verbose:
         logger.debug('Loading %s', representation)
     while True:
-        retry = False
+        if not CIRCUIT_BREAKER.allowRequest(host):
+            raise HostUnavailableError(host)
         try:
-            attempt += 1
-            handlers = [urllib.request.HTTPCookieProcessor]
-            if not verifySsl:
-                context = ssl.create_default_context()
-                context.check_hostname = False
-                # noinspection PyUnresolvedReferences
-                context.verify_mode = ssl.CERT_NONE
-                # noinspection PyTypeChecker
-                handlers.append(urllib.request.HTTPSHandler(0, context, False))
-            opener = urllib.request.build_opener(*handlers)
-            srcObj = opener.open(url, parametersBytes)
-            dstObj = io.BytesIO()
-            while True:
-                chunk = srcObj.read(CHUNK_SIZE_BYTES)
-                if not chunk:
-                    break
-                dstObj.write(chunk)
-            dstObj.seek(0)
-            srcObj.close()
-            if verbose:
-                logger.debug('Finished %s', representation)
-            return dstObj.read()
-        except urllib.error.HTTPError as ex:
-            if httpCodeAnyOf(ex.code, [http.HTTPStatus.BAD_GATEWAY, http.HTTPStatus.GATEWAY_TIMEOUT, http.HTTPStatus.INTERNAL_SERVER_ERROR]):
-                retry = attempt <= 3
-            elif httpCodeAnyOf(ex.code, [http.HTTPStatus.NOT_FOUND, http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE]):
-                raise
-            lastException = ex
-        except urllib.error.URLError as ex:
-            # noinspection PyBroadException
+            retry = False
+            transientFailure = False
             try:
-                errorCode = ex.args[0].errno
-                if errorCode == errno.ECONNREFUSED:
+                attempt += 1
+                opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor, KeepAliveHTTPHandler, KeepAliveHTTPSHandler(verifySsl))
+                with REQUEST_SCHEDULER.request(url):
+                    # Socket timeout bounds every blocking operation, so a stalled server can not hold the attempt longer than the deadline allows
+                    timeout = min(retryPolicy.attemptTimeout, max(0.1, deadline - time.monotonic()))
+                    srcObj = opener.open(urllib.request.Request(url, parametersBytes, requestHeaders), timeout=timeout)
+                    try:
+                        body, wireSize = readResponseBody(srcObj)
+                    finally:
+                        # Connection goes back to the pool only if the whole body has been read, otherwise it is closed right away
+                        srcObj.close()
+                CIRCUIT_BREAKER.recordSuccess(host)
+                TRANSFER_STATS.add(host, wireSize, len(body))
+                if verbose:
+                    logger.debug('Finished %s (%d bytes received, %d bytes decoded)', representation, wireSize, len(body))
+                if cache is not None:
+                    __storeCachedResponse(cache, cacheKey, body, srcObj.headers.get('ETag'), srcObj.headers.get('Last-Modified'), logger)
+                return body
+            except urllib.error.HTTPError as ex:
+                # Body of an error response is never read, so its connection must not wait for garbage collector
+                ex.close()
+                if ex.code == http.HTTPStatus.NOT_MODIFIED and cachedResponse is not None:
+                    CIRCUIT_BREAKER.recordSuccess(host)
+                    __refreshCachedResponse(cache, cacheKey, logger)
+                    if verbose:
+                        logger.debug('Not modified %s', representation)
+                    return cachedResponse.body
+                if httpCodeAnyOf(ex.code, [http.HTTPStatus.BAD_GATEWAY, http.HTTPStatus.GATEWAY_TIMEOUT, http.HTTPStatus.INTERNAL_SERVER_ERROR]):
                     retry = attempt <= 3
-            except Exception:
-                pass
-            lastException = ex
-        except ssl.CertificateError:
-            raise
-        except http.client.BadStatusLine as ex:
-            retry = True
-            lastException = ex
-        except http.client.IncompleteRead as ex:
-            retry = True
-            lastException = ex
-        except Exception as ex:
-            retry = False
-            lastException = ex
-        if retry and attempt <= MAX_ATTEMPTS:
-            logger.debug('Restarting (%s/%s) %s', attempt, MAX_ATTEMPTS, representation)
-            time.sleep(attempt * HTTP_DELAY_SECONDS_MULTIPLIER)
-            continue
+                    transientFailure = True
+                else:
+                    # Whatever the answer is, host is up
+                    CIRCUIT_BREAKER.recordSuccess(host)
+                    if httpCodeAnyOf(ex.code, [http.HTTPStatus.NOT_FOUND, http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE]):
+                        raise
+                lastException = ex
+            except urllib.error.URLError as ex:
+                transientFailure = True
+                # noinspection PyBroadException
+                try:
+                    if isinstance(ex.reason, socket.timeout):
+                        retry = True
+                    elif ex.reason.errno == errno.ECONNREFUSED:
+                        retry = attempt <= 3
+                except Exception:
+                    pass
+                lastException = ex
+            except ssl.CertificateError:
+                raise
+            except (http.client.BadStatusLine, http.client.IncompleteRead, socket.timeout) as ex:
+                retry = True
+                transientFailure = True
+                lastException = ex
+            except Exception as ex:
+                retry = False
+                lastException = ex
+            if transientFailure and CIRCUIT_BREAKER.recordFailure(host):
+                logger.warning('%s is not responding, requests to it will fail fast for %d seconds', host, CIRCUIT_BREAKER.resetTimeout)
+        finally:
+            # Attempt may end without telling whether host is up (certificate error, unexpected exception), its probe must not block host forever
+            CIRCUIT_BREAKER.releaseProbe(host)
+        if retry and attempt < retryPolicy.maxAttempts:
+            delay = retryPolicy.getDelay(attempt)
+            if time.monotonic() + delay > deadline:
+                logger.debug('Deadline exceeded %s', representation)
+            elif not retryPolicy.takeRetry(host):
+                logger.debug('Retry budget exhausted %s', representation)
+            else:
+                logger.debug('Restarting (%s/%s) %s', attempt, retryPolicy.maxAttempts, representation)
+                time.sleep(delay)
+                continue
         raise lastException
+
+
+def readResponseBody(response: http.client.HTTPResponse) -> Tuple[bytes, int]:
+    decoder = createContentDecoder(response.headers.get('Content-Encoding'))
+    if decoder is None and response.length is not None:
+        # http.client reads body of known length straight into a single buffer
+        body = response.read()
+        return body, len(body)
+
+    wireSize = 0
+    chunks = []
+    while True:
+        chunk = response.read(CHUNK_SIZE_BYTES)
+        if not chunk:
+            break
+        wireSize += len(chunk)
+        chunks.append(decoder.decompress(chunk) if decoder is not None else chunk)
+    if decoder is not None:
+        chunks.append(decoder.flush())
+    return b''.join(chunks), wireSize
+
+
+def __loadCachedResponse(cache: HttpResponseCache, key: str, logger: ILogger) -> Optional[CachedResponse]:
+    try:
+        return cache.get(key)
+    except sqlite3.Error as ex:
+        logger.warning('Unable to read response cache: %s', ex)
+        return None
+
+
+def __storeCachedResponse(cache: HttpResponseCache, key: str, body: bytes, etag: Optional[str], lastModified: Optional[str], logger: ILogger) -> None:
+    try:
+        cache.put(key, body, etag, lastModified)
+    except sqlite3.Error as ex:
+        logger.warning('Unable to write response cache: %s', ex)
+
+
+def __refreshCachedResponse(cache: HttpResponseCache, key: str, logger: ILogger) -> None:
+    try:
+        cache.refresh(key)
+    except sqlite3.Error as ex:
+        logger.warning('Unable to write response cache: %s', ex)
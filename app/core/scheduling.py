@@ -0,0 +1,76 @@
+import codecs
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import psutil
+
+
+def get_workers_count(max_count: int, memory_per_worker_bytes: int, reserved_cores: int = 0) -> int:
+    # Hyper-threading siblings do not help parsers much, so only physical cores are taken into account
+    cores_count = psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+    memory_limit = psutil.virtual_memory().available // memory_per_worker_bytes
+    return max(1, min(max_count, cores_count - reserved_cores, memory_limit))
+
+
+def distribute_jobs(job_ids: Iterable[str], workers_count: int, latencies: Dict[str, float], groups: Optional[Dict[str, str]] = None) -> List[List[str]]:
+    # Longest jobs go first, each one to the least loaded worker. Jobs never seen before are considered the slowest ones.
+    # Jobs of the same group share limits of the process they run in, so the whole group goes to a single worker
+    default_latency = max(latencies.values(), default=1.0)
+    groups = groups or {}
+
+    def get_latency(unit: List[str]) -> float:
+        return sum(latencies.get(job_id, default_latency) for job_id in unit)
+
+    def get_order(unit: List[str]) -> tuple:
+        return all(job_id in latencies for job_id in unit), -get_latency(unit)
+
+    units = {}
+    for job_id in job_ids:
+        units.setdefault((job_id in groups, groups.get(job_id, job_id)), []).append(job_id)
+    plan = [[] for _ in range(workers_count)]
+    loads = [0.0] * workers_count
+    for unit in sorted(units.values(), key=get_order):
+        worker_index = min(range(workers_count), key=lambda i: loads[i])
+        plan[worker_index].extend(sorted(unit, key=lambda job_id: get_order([job_id])))
+        loads[worker_index] += get_latency(unit)
+    return plan
+
+
+class LatencyHistory(object):
+    def __init__(self, path: Optional[str], smoothing: float = 0.3):
+        self.__path = path
+        self.__smoothing = smoothing
+        self.__lock = threading.Lock()
+        self.__latencies = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with codecs.open(path, 'r', 'utf-8') as fobj:
+                    self.__latencies = {key: float(value) for key, value in json.load(fobj).items()}
+            except (OSError, ValueError, AttributeError):
+                self.__latencies = {}
+
+    def get(self, key: str) -> Optional[float]:
+        with self.__lock:
+            return self.__latencies.get(key)
+
+    def get_all(self) -> Dict[str, float]:
+        with self.__lock:
+            return dict(self.__latencies)
+
+    def update(self, key: str, seconds: float) -> None:
+        with self.__lock:
+            previous = self.__latencies.get(key)
+            if previous is None:
+                self.__latencies[key] = seconds
+            else:
+                self.__latencies[key] = previous + self.__smoothing * (seconds - previous)
+
+    def save(self) -> None:
+        if self.__path is None:
+            return
+        with self.__lock:
+            latencies = dict(self.__latencies)
+        with codecs.open(self.__path, 'w', 'utf-8') as fobj:
+            json.dump(latencies, fobj, indent=2, sort_keys=True)
@@ -1,5 +1,6 @@
 import codecs
 import enum
+import functools
 import json
 import logging
 import os
@@ -91,6 +92,7 @@ class OsUtils(ABC):
         return platform.system() == 'Linux'
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def is_winxp_or_older(cls):
         return cls.is_windows() and sys.getwindowsversion().major <= 5
 
@@ -1,16 +1,25 @@
 import os
 import subprocess
+import time
 
 import psutil
 
 from card.sources import getCardSourceClasses
+from core.scheduling import get_workers_count
 from core.utils import StderrLogger
 
+PROCESS_MEMORY_BYTES = 256 * 1024 * 1024
+
 
 def main():
     logsPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'log'))
+    classes = getCardSourceClasses()
+    maxProcesses = get_workers_count(len(classes), PROCESS_MEMORY_BYTES)
+    print('Running {} sources at most'.format(maxProcesses))
     processes = []
-    for classObject in getCardSourceClasses():
+    for classObject in classes:
+        while sum(1 for p in processes if p.poll() is None) >= maxProcesses:
+            time.sleep(1)
         source = classObject(StderrLogger(classObject.__name__))
         sourceId = source.getTitle()
         print(sourceId)
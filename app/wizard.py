@@ -1,17 +1,22 @@
+import asyncio
 import logging
 import math
 import os
 import sys
+import time
+import urllib.parse
+from concurrent.futures import Executor, ThreadPoolExecutor
 from functools import partial
 from io import StringIO
 from multiprocessing import Event as MpEvent
 from multiprocessing import Process as MpProcess
 from multiprocessing import Queue as MpQueue
+from multiprocessing import Value as MpValue
 from multiprocessing import freeze_support as mp_freeze_support, set_start_method as mp_set_start_method
 from queue import Queue as SpQueue
 from signal import SIGTERM
 from threading import Thread
-from typing import Callable, ClassVar
+from typing import Callable, ClassVar, Dict, List, Optional, Tuple
 from webbrowser import open as open_browser
 
 import dotenv
@@ -21,12 +26,15 @@ from PyQt5 import QtCore
 from PyQt5 import QtWidgets
 from PyQt5 import uic
 
+import core.network
 import version
 from card.components import SetOracle, ConditionOracle, LanguageOracle
 from card.fixer import CardsFixer
+from card.offers import CardOffer, pack_offers, unpack_offers
 from card.sources import getCardSourceClasses, CardSource
 from card.utils import CardUtils
 from core.components.cbr import CentralBankApiClient
+from core.scheduling import LatencyHistory, distribute_jobs, get_workers_count
 from core.utils import Currency, ILogger, MultiprocessingLogger, OsUtils, StringUtils
 from core.utils import load_json_resource, get_project_root, get_resource_path
 
@@ -55,7 +63,7 @@ SEARCH_RESULTS_TABLE_COLUMNS_INFO = [
     {
         'id': 'name',
         'label': 'Name',
-        'sources': ('name',),
+        'sources': ('caption',),
         'align': QtCore.Qt.AlignLeft,
         'default_value': '',
     },
@@ -102,7 +110,7 @@ SEARCH_RESULTS_TABLE_COLUMNS_INFO = [
     {
         'id': 'source',
         'label': 'Source',
-        'sources': ('source',),
+        'sources': ('source', 'url',),
         'align': QtCore.Qt.AlignLeft,
         'cursor': QtCore.Qt.PointingHandCursor,
         'hyperlink': True,
@@ -111,12 +119,22 @@ SEARCH_RESULTS_TABLE_COLUMNS_INFO = [
     {
         'id': 'description',
         'label': 'Description',
-        'sources': ('name',),
+        'sources': ('description',),
         'align': QtCore.Qt.AlignLeft,
         'default_value': '',
     },
 ]
 
+EMPTY_PRICE = {'amount': None, 'currency': None, 'original_amount': None, 'original_currency': None}
+
+SEARCH_CONCURRENCY = 8
+SEARCH_WORKER_MEMORY_BYTES = 256 * 1024 * 1024
+SEARCH_RESULTS_BATCH_SIZE = 200
+SEARCH_RESULTS_BATCH_INTERVAL_SECONDS = 0.1
+FETCHED_RESULTS_PER_TICK = 500
+TIMER_INTERVAL_MILLISECONDS = 100
+PRICE_UPDATES_FRAME_SHARE = 0.5
+
 VISITED_URLS = set()
 
 
@@ -181,8 +199,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.searchProgressQueue = SpQueue()
         self.searchResults = MpQueue()
 
-        self.searchWorkers = {}
+        self.searchEngines = []
+        self.finishedSearchEngines = set()
+        self.unavailableSearchSources = {}
         self.searchProgressStats = {}
+        # Engine ids sent to every search worker
+        self.searchPlan = []
+
+        self.searchStartTime = None
+        self.searchLatencies = LatencyHistory(os.path.join(os.path.expanduser('~'), '.wots.latency.json'))
+
+        # Search workers are started once and kept warm, every search is sent to them as a job
+        # One core is left for the interface and price workers
+        searchWorkersCount = get_workers_count(len(getCardSourceClasses()), SEARCH_WORKER_MEMORY_BYTES, reserved_cores=1)
+        self.logger.info('Using %d search workers (%s physical cores, %s logical cores, %d MiB of memory available)', searchWorkersCount,
+            psutil.cpu_count(logical=False), psutil.cpu_count(), psutil.virtual_memory().available // (1024 * 1024))
+        self.searchJobs = [MpQueue() for _ in range(searchWorkersCount)]
+        self.activeSearch = MpValue('i', 0)
+        self.searchWorkers = [None] * searchWorkersCount
+        self.startSearchWorkers()
 
         self.priceStopEvent = MpEvent()
         self.priceRequests = MpQueue()
@@ -203,7 +238,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.onTimerTick)
-        self.timer.start(100)
+        self.timer.start(TIMER_INTERVAL_MILLISECONDS)
 
         self.searchStopButton.setVisible(False)
         self.searchStopButton.clicked.connect(self.onSearchStopButtonClick)
@@ -246,9 +281,24 @@ class MainWindow(QtWidgets.QMainWindow):
             if process.is_alive():
                 os.kill(process.pid, SIGTERM)
 
+    def getSearchWorkers(self):
+        return [process for process in self.searchWorkers if process is not None]
+
+    def startSearchWorkers(self):
+        for i, process in enumerate(self.searchWorkers):
+            if process is None or not process.is_alive():
+                # noinspection PyArgumentList
+                process = MpProcess(
+                    name='search{}'.format(i + 1),
+                    target=partial(mpEntryPoint, serveCardSearches),
+                    args=(self.searchJobs[i], self.searchResults, self.logger, self.activeSearch,),
+                    daemon=True)
+                self.searchWorkers[i] = process
+                process.start()
+
     def abort(self):
         self.priceStopEvent.set()
-        self.killWorkers(self.searchWorkers.values())
+        self.killWorkers(self.getSearchWorkers())
         self.killWorkers(self.priceWorkers)
 
     def onSearchResultsCellMouseEnter(self, index):
@@ -263,19 +313,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.searchStartButton.setEnabled(len(text) > 0)
 
     def onSearchStopButtonClick(self):
-        self.searchStopEvent.set()
+        self.activeSearch.value = 0
         self.searchStopButton.setEnabled(False)
         self.searchProgress.setValue(0)
-        self.killWorkers(self.searchWorkers.values())
-        self.searchWorkers = {}
+        self.searchEngines = []
+        self.finishedSearchEngines = set()
+        self.unavailableSearchSources = {}
         self.searchProgressStats = {}
+        self.searchPlan = []
 
     def onTimerTick(self):
+        tickStartTime = time.monotonic()
         if self.searchResultsModel.canFetchMore(None):
             self.searchResultsModel.fetchMore(None)
 
+        # Prices are applied until the given share of the frame is spent, including the time taken by new search results,
+        # so the budget grows when the table is idle and shrinks when it is busy, but at least one price is applied per tick
+        deadline = tickStartTime + TIMER_INTERVAL_MILLISECONDS / 1000 * PRICE_UPDATES_FRAME_SHARE
         batchLength = 0
-        while not self.obtainedPrices.empty() and batchLength <= 10:
+        while not self.obtainedPrices.empty() and (batchLength == 0 or time.monotonic() < deadline):
             row, column, priceInfo, searchVersion = self.obtainedPrices.get()
             if priceInfo and searchVersion == self.searchVersion:
                 if batchLength == 0:
@@ -289,7 +345,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.updateSearchControlsStatus()
 
     def isSearchInProgress(self):
-        return any(process.is_alive() for process in self.searchWorkers.values())
+        return len(self.finishedSearchEngines) < len(self.searchEngines) and any(process.is_alive() for process in self.getSearchWorkers())
 
     def updateSearchControlsStatus(self):
         searchInProgress = self.isSearchInProgress()
@@ -304,13 +360,32 @@ class MainWindow(QtWidgets.QMainWindow):
         if self.searchProgress.isEnabled() != newEnabledState:
             self.searchProgress.setEnabled(newEnabledState)
 
+        unavailableSourcesChanged = False
         while not self.searchProgressQueue.empty():
-            engineId, foundCount, estimCount = self.searchProgressQueue.get()
+            engineId, foundCount, estimCount, finished, unavailableHost = self.searchProgressQueue.get()
             self.searchProgressStats[engineId] = (foundCount, estimCount)
+            if finished and engineId in self.searchEngines and engineId not in self.finishedSearchEngines:
+                self.finishedSearchEngines.add(engineId)
+                if unavailableHost is None:
+                    engineClass, *_ = self.__parseEngineId(engineId)
+                    self.searchLatencies.update(engineClass, time.monotonic() - self.searchStartTime)
+            if unavailableHost is not None:
+                self.unavailableSearchSources[engineId] = unavailableHost
+                unavailableSourcesChanged = True
+        for process, engineIds in zip(self.searchWorkers, self.searchPlan):
+            if process is not None and not process.is_alive():
+                # Sources of a dead worker will never report, so they are considered finished
+                self.finishedSearchEngines.update(engineId for engineId in engineIds if engineId in self.searchEngines)
 
         searchInProgress = self.isSearchInProgress()
         if self.wasSearchInProgress and not searchInProgress:
-            for engineId, worker in self.searchWorkers.items():
+            try:
+                self.searchLatencies.save()
+            except OSError as ex:
+                self.logger.warning('Unable to save search latencies: %s', ex)
+            fixesStats = self.container.get(CardsFixer).getMemoStats()
+            self.logger.info('Fixes memo: %d hits, %d misses, %d entries', fixesStats.hits, fixesStats.misses, fixesStats.entries)
+            for engineId in self.searchEngines:
                 if engineId in self.searchProgressStats:
                     foundCount, estimCount = self.searchProgressStats[engineId]
                     if foundCount != estimCount:
@@ -321,25 +396,27 @@ class MainWindow(QtWidgets.QMainWindow):
         message = None
         if self.searchResultsModel.cardCount == 0:
             message = 'Searching...'
-        elif self.foundCardsCount != self.searchResultsModel.cardCount or searchInProgress != self.wasSearchInProgress:
+        elif self.foundCardsCount != self.searchResultsModel.cardCount or searchInProgress != self.wasSearchInProgress or unavailableSourcesChanged:
             message = '{} entries found.'.format(self.searchResultsModel.cardCount)
             if searchInProgress:
                 message = '{} Searching for more...'.format(message)
             self.foundCardsCount = self.searchResultsModel.cardCount
+        if message is not None and self.unavailableSearchSources:
+            message = '{} Unavailable: {}.'.format(message, ', '.join(sorted(set(self.unavailableSearchSources.values()))))
         # TODO update only if changed !!!!!!!!!!!
         if message is not None:
             self.statusBar.showMessage(message)
 
-        if len(self.searchWorkers) > 0 and currentProgress < 100:
-            weightMultiplier = 1.0 / len(self.searchWorkers)
+        if len(self.searchEngines) > 0 and currentProgress < 100:
+            weightMultiplier = 1.0 / len(self.searchEngines)
             newProgress = 0
-            for engineId, worker in self.searchWorkers.items():
+            for engineId in self.searchEngines:
                 engineProgress = 0
-                if engineId in self.searchProgressStats:
+                if engineId in self.finishedSearchEngines or not searchInProgress:
+                    engineProgress = 100
+                elif engineId in self.searchProgressStats:
                     foundCount, estimCount = self.searchProgressStats[engineId]
                     engineProgress = min(100, foundCount / estimCount * 100) if estimCount > 0 else 100
-                elif not worker.is_alive():
-                    engineProgress = 100
                 if engineProgress > 0:
                     newProgress += min(100, engineProgress) * weightMultiplier
             newProgress = math.ceil(newProgress)
@@ -366,9 +443,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.wasSearchInProgress = False
         self.foundCardsCount = 0
         self.searchVersion += 1
-        self.searchWorkers = {}
+        self.activeSearch.value = self.searchVersion
+        self.searchEngines = []
+        self.finishedSearchEngines = set()
+        self.unavailableSearchSources = {}
         self.searchProgressStats = {}
-        self.searchStopEvent = MpEvent()
         self.searchResultsModel.setCookie(self.searchVersion)
         self.searchResultsModel.clear()
         self.searchProgress.setValue(0)
@@ -376,13 +455,24 @@ class MainWindow(QtWidgets.QMainWindow):
         sourceClasses = getCardSourceClasses()
         # sourceClasses = [card.sources.OfflineTestSource] * 10
 
+        engines = []
         for i, sourceClass in enumerate(sourceClasses):
-            engineId = self.__buildEngineId(sourceClass, i + 1)
-            process = MpProcess(name=str(sourceClass), target=partial(mpEntryPoint, queryCardSource),
-                args=(engineId, sourceClass, queryString, self.searchResults, self.logger, self.searchStopEvent, self.searchVersion))
-            process.daemon = True
-            process.start()
-            self.searchWorkers[engineId] = process
+            engines.append((self.__buildEngineId(sourceClass, i + 1), sourceClass))
+        self.searchEngines = [engineId for engineId, _ in engines]
+        self.startSearchWorkers()
+
+        # Slow sources are started first and spread across workers, so that search finishes as early as possible
+        enginesByClassName = {sourceClass.__name__: (engineId, sourceClass) for engineId, sourceClass in engines}
+        # Request limits, coalescing and circuit breaking are kept per process, so shops sharing hosting are searched by the same worker
+        hostGroups = {className: core.network.REQUEST_SCHEDULER.getGroup(urllib.parse.urlparse(sourceClass.URL).hostname)
+                      for className, (_, sourceClass) in enginesByClassName.items()}
+        plan = distribute_jobs(enginesByClassName.keys(), len(self.searchWorkers), self.searchLatencies.get_all(), hostGroups)
+        self.logger.info('Search plan: %s', '; '.join('worker {}: {}'.format(i + 1, ', '.join(classNames)) for i, classNames in enumerate(plan)))
+        self.searchPlan = [[enginesByClassName[className][0] for className in classNames] for classNames in plan]
+        self.searchStartTime = time.monotonic()
+        for jobsQueue, classNames in zip(self.searchJobs, plan):
+            if len(classNames) > 0:
+                jobsQueue.put(([enginesByClassName[className] for className in classNames], queryString, self.searchVersion,))
 
         self.searchStopButton.setEnabled(True)
         self.updateSearchControlsStatus()
@@ -404,12 +494,131 @@ def mpEntryPoint(original: Callable, *args, **kwargs) -> None:
         raise
 
 
-def queryCardSource(cardSourceId: int, instanceClass, queryString: str, resultsQueue: MpQueue, logger: ILogger, exitEvent: MpEvent, cookie):
-    cardSource: CardSource = instanceClass(logger)
-    for cardInfo in cardSource.query(queryString):
-        if exitEvent.is_set():
-            return
-        resultsQueue.put((cardInfo, (cardSourceId, cardSource.getFoundCardsCount(), cardSource.getEstimatedCardsCount()), cookie,))
+class SearchStopEvent(object):
+    def __init__(self, activeSearch: MpValue, cookie: int):
+        self.activeSearch = activeSearch
+        self.cookie = cookie
+
+    def is_set(self) -> bool:
+        # Search is stopped either explicitly or by starting another one
+        return self.activeSearch.value != self.cookie
+
+
+def serveCardSearches(jobsQueue: MpQueue, resultsQueue: MpQueue, logger: ILogger, activeSearch: MpValue):
+    sentry = raven.Client(os.getenv('SENTRY_DSN'))
+
+    # Sources are constructed on the first job they are assigned to and are then kept idle between searches, one per class
+    idleSources = {}
+
+    # Stopped searches may still wait for their network calls, so jobs are run concurrently on a loop of their own
+    loop = asyncio.new_event_loop()
+    loopThread = Thread(target=loop.run_forever, name='search-loop', daemon=True)
+    loopThread.start()
+    try:
+        while True:
+            job = jobsQueue.get()
+            if job is None:
+                break
+            engines, queryString, cookie = job
+            exitEvent = SearchStopEvent(activeSearch, cookie)
+            if exitEvent.is_set():
+                continue
+            future = asyncio.run_coroutine_threadsafe(
+                runSearchJob(engines, queryString, SearchResultsBatcher(resultsQueue, cookie), logger, exitEvent, sentry, idleSources), loop)
+            future.add_done_callback(partial(reportFailedSearchJob, engines, resultsQueue, cookie, logger, sentry))
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def reportFailedSearchJob(engines: List[Tuple[str, type]], resultsQueue: MpQueue, cookie: int, logger: ILogger, sentry: raven.Client, future) -> None:
+    if future.cancelled() or future.exception() is None:
+        return
+    ex = future.exception()
+    sentry.captureException((type(ex), ex, ex.__traceback__))
+    logger.error('Search job failed: %s', repr(ex))
+    # Otherwise the interface would wait for these sources forever
+    resultsQueue.put((pack_offers([]), [(engineId, 0, 0, True, None) for engineId, _ in engines], cookie,))
+
+
+class SearchResultsBatcher(object):
+    def __init__(self, resultsQueue: MpQueue, cookie: int):
+        self.resultsQueue = resultsQueue
+        self.cookie = cookie
+        self.offers = []
+        self.stats = {}
+
+    def add(self, cardInfo: Optional[CardOffer], statInfo: tuple) -> None:
+        if cardInfo is not None:
+            self.offers.append(cardInfo)
+        # Only the latest stats of each source matter
+        self.stats[statInfo[0]] = statInfo
+        finished = statInfo[3]
+        if finished or len(self.offers) >= SEARCH_RESULTS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.offers) > 0 or len(self.stats) > 0:
+            self.resultsQueue.put((pack_offers(self.offers), list(self.stats.values()), self.cookie,))
+            self.offers = []
+            self.stats = {}
+
+    async def flushPeriodically(self) -> None:
+        while True:
+            await asyncio.sleep(SEARCH_RESULTS_BATCH_INTERVAL_SECONDS)
+            self.flush()
+
+
+async def runSearchJob(engines: List[Tuple[str, type]], queryString: str, batcher: SearchResultsBatcher, logger: ILogger, exitEvent: SearchStopEvent,
+                       sentry: raven.Client, idleSources: Dict[type, CardSource]):
+    # Stopped source keeps its thread until the network call it waits for is over, so every job has threads of its own and does not queue behind stopped ones
+    executor = ThreadPoolExecutor(SEARCH_CONCURRENCY)
+    flusher = asyncio.ensure_future(batcher.flushPeriodically())
+    try:
+        await asyncio.gather(*[
+            queryCardSource(engineId, sourceClass, queryString, batcher, logger, exitEvent, executor, sentry, idleSources)
+            for engineId, sourceClass in engines
+        ])
+    finally:
+        flusher.cancel()
+        executor.shutdown(wait=False)
+        batcher.flush()
+
+
+async def queryCardSource(cardSourceId: str, instanceClass, queryString: str, batcher: SearchResultsBatcher, logger: ILogger, exitEvent: SearchStopEvent, executor: Executor,
+                          sentry: raven.Client, idleSources: Dict[type, CardSource]):
+    cardSource: CardSource = None
+    unavailableHost = None
+    try:
+        # Idle sources are only touched from the loop thread, so no locking is needed
+        cardSource = idleSources.pop(instanceClass, None)
+        if cardSource is None:
+            cardSource = await asyncio.get_event_loop().run_in_executor(executor, instanceClass, logger)
+        cardInfos = cardSource.queryAsync(queryString, executor)
+        try:
+            async for cardInfo in cardInfos:
+                if exitEvent.is_set():
+                    return
+                batcher.add(cardInfo, (cardSourceId, cardSource.getFoundCardsCount(), cardSource.getEstimatedCardsCount(), False, None))
+        finally:
+            # Source goes back to the idle ones, so its query must be finished right now rather than on garbage collection
+            await cardInfos.aclose()
+    except core.network.HostUnavailableError as ex:
+        unavailableHost = ex.host
+        logger.get_child(instanceClass.__name__).warning('Search failed: %s', ex.reason)
+    except Exception as ex:
+        sentry.captureException()
+        logger.get_child(instanceClass.__name__).error('Search failed: %s', repr(ex))
+    finally:
+        foundCount, estimCount = 0, None
+        if cardSource is not None:
+            foundCount, estimCount = cardSource.getFoundCardsCount(), cardSource.getEstimatedCardsCount()
+            # Overlapping searches may have built another instance meanwhile, only one of them is kept
+            if instanceClass in idleSources:
+                cardSource.close()
+            else:
+                cardSource.requestCache.clear()
+                idleSources[instanceClass] = cardSource
+        batcher.add(None, (cardSourceId, foundCount, estimCount if estimCount is not None else foundCount, True, unavailableHost))
 
 
 def queryPriceSource(priceSourceClass, sourceId, storagePath, resources, requestsQueue, resultsQueue, exitEvent):
@@ -447,7 +656,9 @@ class CardsTableModel(QtCore.QAbstractTableModel):
         self.langOracle = self.container.get(LanguageOracle)
         self.setOracle = self.container.get(SetOracle)
         self.conditionOracle = self.container.get(ConditionOracle)
-        self.dataTable = []
+        self.conditionsOrder = {condition: i for i, condition in enumerate(ConditionOracle.get_order())}
+        self.alignments = [columnInfo['align'] + QtCore.Qt.AlignVCenter for columnInfo in columnsInfo]
+        self.displayValues, self.toolTips, self.sortKeys = self.__createColumns()
         self.cardCount = 0
 
     def setCookie(self, cookie):
@@ -455,10 +666,63 @@ class CardsTableModel(QtCore.QAbstractTableModel):
 
     def clear(self):
         self.beginRemoveRows(QtCore.QModelIndex(), 0, self.cardCount - 1)
-        self.dataTable = []
+        self.displayValues, self.toolTips, self.sortKeys = self.__createColumns()
         self.cardCount = 0
         self.endRemoveRows()
 
+    def __createColumns(self):
+        # Table is stored by columns, every cell is rendered once when it is added or updated, not on every paint
+        return [[] for _ in self.columnsInfo], [[] for _ in self.columnsInfo], [[] for _ in self.columnsInfo]
+
+    def __renderCell(self, columnId: str, values: dict) -> tuple:
+        # Returns display value, tooltip and sort key of the cell
+        if columnId == 'number':
+            cardId = values['id']
+            return str(cardId).zfill(3) if cardId > 0 else None, None, cardId
+        elif columnId == 'set':
+            setAbbrv = values['set']
+            return setAbbrv, self.setOracle.get_name(setAbbrv) if setAbbrv else None, setAbbrv
+        elif columnId == 'language':
+            lang = values['language']
+            return lang, self.langOracle.get_name(lang) if lang else None, lang
+        elif columnId == 'name':
+            caption = values['caption']
+            return CardUtils.std2utf(caption), None, caption
+        elif columnId == 'condition':
+            condition = values['condition']
+            if not condition:
+                return condition, None, -1
+            return condition, self.conditionOracle.get_name(condition), self.conditionsOrder.get(condition, len(self.conditionsOrder))
+        elif columnId == 'foilness':
+            foilness = values['foilness']
+            return 'Foil' if foilness else None, None, bool(foilness)  # TODO image
+        elif columnId == 'count':
+            count = values['count']
+            countPlus = isinstance(count, bool) and count is True
+            countValue = int(count) if count is not None else 0
+            return '1+' if countPlus else countValue or '', None, (countValue, countPlus)
+        elif columnId.endswith('price'):
+            amount, currency = values['amount'], values['currency']
+            if amount is None:
+                return None, None, (True, 0, 0)
+            toolTip = StringUtils.format_money(values['original_amount'], values['original_currency']) if currency != values['original_currency'] else ''
+            return StringUtils.format_money(int(amount), currency), toolTip, (False, currency or 0, amount)
+        elif columnId == 'source':
+            return values['source'], values['url'], values['source']
+        elif columnId == 'description':
+            return values['description'], None, values['description']
+        value = next(iter(values.values()), None)
+        return value, None, value
+
+    def __setCell(self, row: int, column: int, cell: tuple) -> None:
+        self.displayValues[column][row], self.toolTips[column][row], self.sortKeys[column][row] = cell
+
+    def __appendCell(self, column: int, cell: tuple) -> None:
+        displayValue, toolTip, sortKey = cell
+        self.displayValues[column].append(displayValue)
+        self.toolTips[column].append(toolTip)
+        self.sortKeys[column].append(sortKey)
+
     def rowCount(self, parent):
         return self.cardCount
 
@@ -467,60 +731,12 @@ class CardsTableModel(QtCore.QAbstractTableModel):
 
     def data(self, index, role):
         if index.isValid():
-            columnIndex = index.column()
-            columnInfo = self.columnsInfo[columnIndex]
-            columnId = columnInfo['id']
-            data = self.dataTable[index.row()][columnIndex]
-
-            if role == QtCore.Qt.TextAlignmentRole:
-                return columnInfo['align'] + QtCore.Qt.AlignVCenter
-
-            if columnId == 'number':
-                if role == QtCore.Qt.DisplayRole:
-                    return str(data['id']).zfill(3) if data['id'] > 0 else None
-            elif columnId == 'set':
-                setAbbrv = data['set']
-                if role == QtCore.Qt.DisplayRole:
-                    return setAbbrv
-                elif role == QtCore.Qt.ToolTipRole:
-                    return self.setOracle.get_name(setAbbrv) if setAbbrv else None
-            elif columnId == 'language':
-                lang = data['language']
-                if role == QtCore.Qt.DisplayRole:
-                    return lang
-                elif role == QtCore.Qt.ToolTipRole:
-                    return self.langOracle.get_name(lang) if lang else None
-            elif columnId == 'name':
-                if role == QtCore.Qt.DisplayRole:
-                    return CardUtils.std2utf(data['name']['caption'])
-            elif columnId == 'condition':
-                condition = data['condition']
-                if role == QtCore.Qt.DisplayRole:
-                    return condition
-                elif role == QtCore.Qt.ToolTipRole:
-                    return self.conditionOracle.get_name(condition) if condition else None
-            elif columnId == 'foilness':
-                if role == QtCore.Qt.DisplayRole:
-                    return 'Foil' if data['foilness'] else None  # TODO image
-            elif columnId == 'count':
-                if role == QtCore.Qt.DisplayRole:
-                    if isinstance(data['count'], bool) and data['count'] is True:
-                        return '1+'
-                    return int(data['count']) or ''
-            elif columnId.endswith('price') and data and data['amount'] is not None:
-                if role == QtCore.Qt.DisplayRole:
-                    return StringUtils.format_money(int(data['amount']), data['currency'])
-                elif role == QtCore.Qt.ToolTipRole:
-                    return StringUtils.format_money(data['original_amount'], data['original_currency']) if data['currency'] != data['original_currency'] else ''
-            elif columnId == 'source':
-                if role == QtCore.Qt.DisplayRole:
-                    return data['source']['caption']
-                elif role == QtCore.Qt.ToolTipRole:
-                    return data['source']['url']
-            elif columnId == 'description':
-                if role == QtCore.Qt.DisplayRole:
-                    return data['name']['description']
-
+            if role == QtCore.Qt.DisplayRole:
+                return self.displayValues[index.column()][index.row()]
+            elif role == QtCore.Qt.ToolTipRole:
+                return self.toolTips[index.column()][index.row()]
+            elif role == QtCore.Qt.TextAlignmentRole:
+                return self.alignments[index.column()]
         return QtCore.QVariant()
 
     def headerData(self, section, orientation, role):
@@ -534,47 +750,48 @@ class CardsTableModel(QtCore.QAbstractTableModel):
 
     def fetchMore(self, parent):
         batch = []
-        batchLength = 0
-        while not self.dataQueue.empty() and batchLength <= 100:
-            cardInfo, statInfo, cookie = self.dataQueue.get(block=False)
+        while not self.dataQueue.empty() and len(batch) < FETCHED_RESULTS_PER_TICK:
+            offersBlock, stats, cookie = self.dataQueue.get(block=False)
             if cookie == self.cookie:
-                if cardInfo:
-                    batch.append(cardInfo)
-                    batchLength += 1
-                self.statQueue.put(statInfo)
+                batch.extend(unpack_offers(offersBlock))
+                for statInfo in stats:
+                    self.statQueue.put(statInfo)
+        batchLength = len(batch)
+        if batchLength == 0:
+            return
         self.beginInsertRows(QtCore.QModelIndex(), self.cardCount, self.cardCount + batchLength - 1)
-        for rawCardInfo in batch:
-            cardInfo = self.cardsFixer.fixCardInfo(rawCardInfo)
-
-            rowData = []
-            for columnInfo in self.columnsInfo:
-                columnData = {}
-                for sourceId in columnInfo['sources']:
-                    columnData[sourceId] = cardInfo.get(sourceId, None) or columnInfo['default_value']
-
-                if columnInfo['id'].endswith('price') and len(columnData) > 0:
-                    columnData = self.convertPrice(columnData)
+        for i, cardInfo in enumerate(self.cardsFixer.fixBatch(batch)):
+            for columnIndex, columnInfo in enumerate(self.columnsInfo):
+                values = {sourceId: getattr(cardInfo, sourceId) or columnInfo['default_value'] for sourceId in columnInfo['sources']}
+                if columnInfo['id'].endswith('price'):
+                    values = self.convertPrice(values) if len(values) > 0 else EMPTY_PRICE
+                self.__appendCell(columnIndex, self.__renderCell(columnInfo['id'], values))
 
-                rowData.append(columnData)
-            self.dataTable.append(rowData)
-
-            if cardInfo.get('set'):
-                self.priceRequests.put((len(self.dataTable) - 1, self.cookie, cardInfo['name']['caption'], cardInfo['set'], cardInfo['language'], cardInfo.get('foilness', False),))
+            if cardInfo.set:
+                self.priceRequests.put((self.cardCount + i, self.cookie, cardInfo.caption, cardInfo.set, cardInfo.language, cardInfo.foilness or False,))
 
         self.cardCount += batchLength
         self.endInsertRows()
 
     def beginUpdateCells(self):
-        self.updatedCells = []
+        self.updatedCells = {}
 
     def updateCell(self, row, column, value):
-        self.dataTable[row][column] = value
-        self.updatedCells.append((row, column))
+        self.__setCell(row, column, self.__renderCell(self.columnsInfo[column]['id'], value))
+        self.updatedCells.setdefault(column, set()).add(row)
 
     def endUpdateCells(self):
-        # TODO Optimize
-        for row, column in self.updatedCells:
-            self.dataChanged.emit(self.index(row, column), self.index(row, column))
+        # Views repaint once per contiguous range of rows instead of once per cell
+        for column, rows in self.updatedCells.items():
+            rows = sorted(rows)
+            firstRow = lastRow = rows[0]
+            for row in rows[1:]:
+                if row != lastRow + 1:
+                    self.dataChanged.emit(self.index(firstRow, column), self.index(lastRow, column))
+                    firstRow = row
+                lastRow = row
+            self.dataChanged.emit(self.index(firstRow, column), self.index(lastRow, column))
+        self.updatedCells = {}
 
     def convertPrice(self, priceInfo):
         amount, currency = priceInfo['price'], priceInfo['currency']
@@ -592,59 +809,10 @@ class CardsSortProxy(QtCore.QSortFilterProxyModel):
     def __init__(self, columnsInfo):
         super().__init__()
         self.columnsInfo = columnsInfo
-        self.conditionsOrder = ConditionOracle.get_order()
 
     def lessThan(self, aIndex, bIndex):
-        model = self.sourceModel()
-        columnIndex = aIndex.column()
-        a = model.dataTable[aIndex.row()][columnIndex]
-        b = model.dataTable[bIndex.row()][columnIndex]
-
-        columnId = self.columnsInfo[columnIndex]['id']
-        if columnId == 'number':
-            return a['id'] < b['id']
-        elif columnId == 'set':
-            return a['set'] < b['set']
-        elif columnId == 'language':
-            return a['language'] < b['language']
-        elif columnId == 'name':
-            return a['name']['caption'] < b['name']['caption']
-        elif columnId == 'condition':
-            if not a['condition']:
-                return True
-            if not b['condition']:
-                return False
-            return self.conditionsOrder.index(a['condition']) < self.conditionsOrder.index(b['condition'])
-        elif columnId == 'foilness':
-            return a['foilness'] < b['foilness']
-        elif columnId == 'count':
-            ac = a['count']
-            bc = b['count']
-            ap = isinstance(ac, bool) and ac is True
-            bp = isinstance(bc, bool) and bc is True
-            ai = int(ac) if ac is not None else 0
-            bi = int(bc) if bc is not None else 0
-            if ai == bi and ap != bp:
-                return bp
-            return ai < bi
-        elif columnId.endswith('price'):
-            if not a:
-                return False
-            if not b:
-                return True
-            am, bm = a['amount'], b['amount']
-            if am is None:
-                return False
-            if bm is None:
-                return True
-            if a['currency'] != b['currency']:
-                return a['currency'] < b['currency']
-            return am < bm
-        elif columnId == 'source':
-            return a['source']['caption'] < b['source']['caption']
-        elif columnId == 'description':
-            return a['name']['description'] < b['name']['description']
-        return a < b
+        sortKeys = self.sourceModel().sortKeys[aIndex.column()]
+        return sortKeys[aIndex.row()] < sortKeys[bIndex.row()]
 
 
 def __get_main_process():
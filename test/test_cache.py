@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from core.cache import HttpResponseCache, LruCache
+
+
+class TestLruCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LruCache(100)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 'value', 10)
+        self.assertEqual('value', cache.get('a'))
+        self.assertIn('a', cache)
+        self.assertEqual(1, len(cache))
+        cache.put('a', 'new', 20)
+        self.assertEqual('new', cache.get('a'))
+        self.assertEqual((2, 1, 0, 1, 20), cache.get_stats())
+
+    def test_eviction(self):
+        cache = LruCache(100)
+        cache.put('a', 'a', 40)
+        cache.put('b', 'b', 40)
+        cache.get('a')
+        cache.put('c', 'c', 40)
+        self.assertEqual('a', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('c', cache.get('c'))
+        stats = cache.get_stats()
+        self.assertEqual(1, stats.evictions)
+        self.assertEqual(80, stats.size_bytes)
+
+    def test_oversized(self):
+        cache = LruCache(100)
+        cache.put('a', 'a', 40)
+        cache.put('b', 'b', 101)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('a', cache.get('a'))
+
+    def test_clear(self):
+        cache = LruCache(100)
+        cache.put('a', 'a', 40)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.get_stats().size_bytes)
+
+
+class TestHttpResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = HttpResponseCache(os.path.join(self.directory, 'http.db'), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_make_key(self):
+        key = HttpResponseCache.make_key('GET', 'http://a.ru', None)
+        self.assertEqual(key, HttpResponseCache.make_key('GET', 'http://a.ru', b''))
+        self.assertNotEqual(key, HttpResponseCache.make_key('POST', 'http://a.ru', None))
+        self.assertNotEqual(key, HttpResponseCache.make_key('GET', 'http://b.ru', None))
+        self.assertNotEqual(HttpResponseCache.make_key('POST', 'http://a.ru', b'x=1'), HttpResponseCache.make_key('POST', 'http://a.ru', b'x=2'))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', b'body', '"etag"', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        response = self.cache.get('a')
+        self.assertEqual(b'body', response.body)
+        self.assertEqual('"etag"', response.etag)
+        self.assertEqual('Mon, 01 Jan 2018 00:00:00 GMT', response.last_modified)
+        self.cache.put('a', b'new', None, None)
+        self.assertEqual(b'new', self.cache.get('a').body)
+        self.assertIsNone(self.cache.get('a').etag)
+
+    def test_refresh(self):
+        self.cache.put('a', b'body', None, None)
+        stored_at = self.cache.get('a').stored_at
+        self.cache.refresh('a')
+        self.assertGreaterEqual(self.cache.get('a').stored_at, stored_at)
+
+    def test_eviction(self):
+        for key in ['a', 'b']:
+            self.cache.put(key, key.encode() * 40, None, None)
+            time.sleep(0.02)
+        self.cache.get('a')
+        time.sleep(0.02)
+        self.cache.put('c', b'c' * 40, None, None)
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(80, self.cache.get_size())
+
+    def test_oversized(self):
+        self.cache.put('a', b'a' * 101, None, None)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.get_size())
+
+    def test_clear(self):
+        self.cache.put('a', b'body', None, None)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
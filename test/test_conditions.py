@@ -17,3 +17,14 @@ class TestConditionOracle(OracleTest):
 
     def test_order(self):
         self.assertEqual(('HP', 'MP', 'SP', 'NM'), ConditionOracle.get_order())
+
+    def test_memo(self):
+        other_oracle = ConditionOracle(StderrLogger('condition_oracle'), thorough=True)
+        stats = self.oracle.get_memo_stats()
+        self.assertEqual('SP', self.oracle.get_abbreviation(' Very Fine '))
+        self.assertEqual('SP', other_oracle.get_abbreviation(' Very Fine '))
+        self.assertIsNone(self.oracle.get_abbreviation('Unknown condition', quiet=True))
+        self.assertIsNone(other_oracle.get_abbreviation('Unknown condition', quiet=True))
+        new_stats = other_oracle.get_memo_stats()
+        self.assertEqual(stats.hits + 2, new_stats.hits)
+        self.assertEqual(stats.misses + 2, new_stats.misses)
@@ -0,0 +1,88 @@
+import unittest
+
+from card.components import LanguageOracle, SetOracle
+from card.fixer import CardsFixer
+from card.offers import CardOffer
+from core.utils import StderrLogger
+
+CARDS_INFO = {
+    'Magic 2019': {'languages': ['ENG', 'RUS'], 'foil': ['Yes'], 'cards': {'shock': [156, 'Yes'], 'lightningstrike': [152, 'Yes']}},
+    'Dominaria': {'languages': ['ENG', 'RUS'], 'foil': ['Yes'], 'cards': {'lightningstrike': [137, 'Yes']}},
+    'Portal Three Kingdoms': {'languages': ['ENG'], 'foil': ['No'], 'cards': {'lightningstrike': [None, 'No']}},
+}
+CARDS_NAMES = {
+    'shock': ['Shock'],
+    'шок': ['Shock'],
+    'lightningstrike': ['Lightning Strike'],
+}
+
+
+def makeOffer(cardId, caption, setId=None, language=None, foilness=None):
+    return CardOffer(cardId, caption, None, setId, language, 'NM', foilness, 1, None, None, 'shop', 'http://shop/{}'.format(cardId))
+
+
+class TestCardsFixer(unittest.TestCase):
+    def get_fixer(self):
+        logger = StderrLogger('fixer')
+        return CardsFixer(CARDS_INFO, CARDS_NAMES, SetOracle(logger, thorough=False), LanguageOracle(logger, thorough=False), logger)
+
+    def test_fix(self):
+        fixer = self.get_fixer()
+        offer = fixer.fixCardInfo(makeOffer(1, 'Шок', language='RU'))
+        self.assertEqual((156, 'Shock', '', 'M19', 'RU', None), (offer.id, offer.caption, offer.description, offer.set, offer.language, offer.foilness))
+        offer = fixer.fixCardInfo(makeOffer(2, 'Lightning Strike', 'DOM', 'EN'))
+        self.assertEqual((137, 'DOM', 'EN'), (offer.id, offer.set, offer.language))
+        offer = fixer.fixCardInfo(makeOffer(3, 'Lightning Strike', 'PTK', 'RU', True))
+        self.assertEqual((3, 'PTK', 'EN', False), (offer.id, offer.set, offer.language, offer.foilness))
+        offer = fixer.fixCardInfo(makeOffer(4, 'Lightning Strike', language='RU', foilness=False))
+        self.assertEqual((4, None, 'RU', False), (offer.id, offer.set, offer.language, offer.foilness))
+        offer = fixer.fixCardInfo(makeOffer(5, 'Shock', 'DOM'))
+        self.assertEqual((156, 'M19'), (offer.id, offer.set))
+        self.assertEqual(('NM', 'shop', 'http://shop/5'), (offer.condition, offer.source, offer.url))
+
+    def test_batch(self):
+        offers = [
+            makeOffer(1, 'Шок', language='RU'),
+            makeOffer(2, 'Shock', 'M19', 'EN', True),
+            makeOffer(3, 'Lightning Strike'),
+            makeOffer(4, 'Lightning Strike', 'PTK', 'RU'),
+            makeOffer(5, 'Lightning Strike', language='EN'),
+            makeOffer(6, 'Lightning Strike', 'DOM', foilness=True),
+            makeOffer(7, 'Шок', language='EN'),
+            makeOffer(None, 'Unknown Card', 'DOM'),
+        ]
+        expected = [
+            (156, 'Shock', 'M19', 'RU', None),
+            (156, 'Shock', 'M19', 'EN', True),
+            (3, 'Lightning Strike', None, None, None),
+            (4, 'Lightning Strike', 'PTK', 'EN', False),
+            (5, 'Lightning Strike', None, 'EN', None),
+            (137, 'Lightning Strike', 'DOM', None, True),
+            (156, 'Shock', 'M19', 'EN', None),
+            (None, 'Unknown Card', None, None, None),
+        ]
+        fixer = self.get_fixer()
+        self.assertEqual(expected, [(offer.id, offer.caption, offer.set, offer.language, offer.foilness) for offer in fixer.fixBatch(offers)])
+        # Offers 5 and 7 have the same caption, set and foilness as offers 3 and 1
+        self.assertEqual((2, 6, 6), (fixer.getMemoStats().hits, fixer.getMemoStats().misses, fixer.getMemoStats().entries))
+
+    def test_memo(self):
+        fixer = self.get_fixer()
+        first = fixer.fixCardInfo(makeOffer(1, 'Lightning Strike', language='EN'))
+        second = fixer.fixCardInfo(makeOffer(2, 'Lightning Strike', language='RU'))
+        self.assertEqual((1, 1), fixer.getMemoStats()[:2])
+        # Id and language are kept per offer even if the fix is shared
+        self.assertEqual((1, 'EN'), (first.id, first.language))
+        self.assertEqual((2, 'RU'), (second.id, second.language))
+
+        fixer.fixCardInfo(makeOffer(3, 'Lightning Strike', 'DOM', 'EN'))
+        fixer.fixCardInfo(makeOffer(4, 'Lightning Strike', language='EN', foilness=True))
+        self.assertEqual((1, 3, 3), (fixer.getMemoStats().hits, fixer.getMemoStats().misses, fixer.getMemoStats().entries))
+
+        fixed = fixer.fixCardInfo(makeOffer(5, 'Lightning Strike', 'DOM', 'RU'))
+        self.assertEqual((137, 'DOM', 'RU'), (fixed.id, fixed.set, fixed.language))
+        self.assertEqual(2, fixer.getMemoStats().hits)
+
+
+if __name__ == '__main__':
+    unittest.main()
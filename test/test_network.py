@@ -0,0 +1,485 @@
+import email.message
+import gzip
+import http.server
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import types
+import unittest
+import urllib.error
+import urllib.request
+import zipfile
+import zlib
+from unittest import mock
+
+import core.network
+from core.network import CircuitBreaker, CircuitState, FixtureArchive, FixtureMissingError, FixtureMode, KeepAliveHTTPHandler, RequestCoalescer, \
+    RequestScheduler, RetryPolicy, TokenBucket, TransferStats, readResponseBody
+from core.utils import StderrLogger
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(1, 3)
+        for _ in range(3):
+            self.assertEqual(0, bucket.reserve())
+        self.assertGreater(bucket.reserve(), 0.9)
+        self.assertGreater(bucket.reserve(), 1.9)
+
+    def test_try_take(self):
+        bucket = TokenBucket(1, 2)
+        self.assertTrue(bucket.tryTake())
+        self.assertTrue(bucket.tryTake())
+        self.assertFalse(bucket.tryTake())
+        self.assertEqual(0, bucket.reserve() // 1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delay(self):
+        policy = RetryPolicy(baseDelay=1, maxDelay=10)
+        for attempt in range(1, 10):
+            delay = policy.getDelay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10, 2 ** (attempt - 1)))
+
+    def test_host_budget(self):
+        policy = RetryPolicy(hostBudget=2, hostBudgetRefillRate=0.001)
+        self.assertTrue(policy.takeRetry('a.ru'))
+        self.assertTrue(policy.takeRetry('a.ru'))
+        self.assertFalse(policy.takeRetry('a.ru'))
+        self.assertTrue(policy.takeRetry('b.ru'))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open(self):
+        breaker = CircuitBreaker(2, 60)
+        self.assertFalse(breaker.recordFailure('a.ru'))
+        self.assertTrue(breaker.allowRequest('a.ru'))
+        self.assertTrue(breaker.recordFailure('a.ru'))
+        self.assertEqual(CircuitState.OPEN, breaker.getState('a.ru'))
+        self.assertFalse(breaker.allowRequest('a.ru'))
+        self.assertTrue(breaker.allowRequest('b.ru'))
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(2, 60)
+        breaker.recordFailure('a.ru')
+        breaker.recordSuccess('a.ru')
+        self.assertFalse(breaker.recordFailure('a.ru'))
+        self.assertEqual(CircuitState.CLOSED, breaker.getState('a.ru'))
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(1, 0.05)
+        breaker.recordFailure('a.ru')
+        time.sleep(0.06)
+        self.assertEqual(CircuitState.HALF_OPEN, breaker.getState('a.ru'))
+        self.assertTrue(breaker.allowRequest('a.ru'))
+        self.assertFalse(breaker.allowRequest('a.ru'))
+        self.assertTrue(breaker.recordFailure('a.ru'))
+        self.assertEqual(CircuitState.OPEN, breaker.getState('a.ru'))
+        time.sleep(0.06)
+        self.assertTrue(breaker.allowRequest('a.ru'))
+        breaker.recordSuccess('a.ru')
+        self.assertEqual(CircuitState.CLOSED, breaker.getState('a.ru'))
+
+    def test_release_probe(self):
+        breaker = CircuitBreaker(1, 0.05)
+        breaker.recordFailure('a.ru')
+        time.sleep(0.06)
+        self.assertTrue(breaker.allowRequest('a.ru'))
+        # Only the thread sending the probe may release it
+        thread = threading.Thread(target=breaker.releaseProbe, args=('a.ru',))
+        thread.start()
+        thread.join()
+        self.assertFalse(breaker.allowRequest('a.ru'))
+        breaker.releaseProbe('a.ru')
+        self.assertEqual(CircuitState.HALF_OPEN, breaker.getState('a.ru'))
+        self.assertTrue(breaker.allowRequest('a.ru'))
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def run_concurrently(self, scheduler: RequestScheduler, urls: list) -> int:
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0}
+
+        def request(url):
+            with scheduler.request(url):
+                with lock:
+                    state['active'] += 1
+                    state['max_active'] = max(state['max_active'], state['active'])
+                time.sleep(0.05)
+                with lock:
+                    state['active'] -= 1
+
+        threads = [threading.Thread(target=request, args=(url,)) for url in urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return state['max_active']
+
+    def test_host_concurrency(self):
+        scheduler = RequestScheduler(1000, 1000, 2, 1000, 1000, 10)
+        self.assertEqual(2, self.run_concurrently(scheduler, ['http://127.0.0.1/{}'.format(i) for i in range(6)]))
+
+    def test_group_concurrency(self):
+        scheduler = RequestScheduler(1000, 1000, 10, 1000, 1000, 1)
+        self.assertEqual(1, self.run_concurrently(scheduler, ['http://127.0.0.1/', 'http://localhost/'] * 2))
+
+    def test_rate(self):
+        scheduler = RequestScheduler(20, 1, 10, 1000, 1000, 10)
+        started = time.monotonic()
+        for _ in range(3):
+            with scheduler.request('http://127.0.0.1/'):
+                pass
+        self.assertGreater(time.monotonic() - started, 0.09)
+
+
+class TestRequestCoalescer(unittest.TestCase):
+    def test_concurrent_calls(self):
+        coalescer = RequestCoalescer()
+        calls = []
+        results = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.1)
+            return object()
+
+        threads = [threading.Thread(target=lambda: results.append(coalescer.run('key', load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(5, len(results))
+        self.assertEqual(1, len(set(id(result) for result in results)))
+
+    def test_sequential_calls(self):
+        coalescer = RequestCoalescer()
+        self.assertEqual(1, coalescer.run('key', lambda: 1))
+        self.assertEqual(2, coalescer.run('key', lambda: 2))
+
+    def test_exception(self):
+        coalescer = RequestCoalescer()
+
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, coalescer.run, 'key', fail)
+        self.assertEqual(1, coalescer.run('key', lambda: 1))
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, body, contentEncoding=None, length=None):
+        super().__init__(body)
+        self.headers = email.message.Message()
+        if contentEncoding is not None:
+            self.headers['Content-Encoding'] = contentEncoding
+        self.length = length
+
+
+class TestReadResponseBody(unittest.TestCase):
+    BODY = b'<html><body>' + b'<tr><td>Black Lotus</td></tr>' * 10000 + b'</body></html>'
+
+    def test_identity(self):
+        self.assertEqual((self.BODY, len(self.BODY)), readResponseBody(FakeResponse(self.BODY, length=len(self.BODY))))
+        self.assertEqual((self.BODY, len(self.BODY)), readResponseBody(FakeResponse(self.BODY)))
+
+    def test_gzip(self):
+        compressed = gzip.compress(self.BODY)
+        self.assertEqual((self.BODY, len(compressed)), readResponseBody(FakeResponse(compressed, 'gzip', len(compressed))))
+
+    def test_deflate(self):
+        compressed = zlib.compress(self.BODY)
+        self.assertEqual((self.BODY, len(compressed)), readResponseBody(FakeResponse(compressed, 'deflate')))
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        compressed = compressor.compress(self.BODY) + compressor.flush()
+        self.assertEqual((self.BODY, len(compressed)), readResponseBody(FakeResponse(compressed, 'Deflate')))
+
+    def test_unknown_encoding(self):
+        self.assertEqual((self.BODY, len(self.BODY)), readResponseBody(FakeResponse(self.BODY, 'compress')))
+
+    def test_brotli(self):
+        # Both brotli packages are emulated with zlib, only their decompressor interfaces matter here
+        class GoogleDecompressor(object):
+            def __init__(self):
+                self.process = zlib.decompressobj().decompress
+
+        class BrotlipyDecompressor(object):
+            def __init__(self):
+                self.decompress = zlib.decompressobj().decompress
+
+        compressed = zlib.compress(self.BODY)
+        for decompressorClass in (GoogleDecompressor, BrotlipyDecompressor):
+            with mock.patch.object(core.network, 'brotli', types.SimpleNamespace(Decompressor=decompressorClass)), \
+                    mock.patch.object(core.network, 'BROTLI_SUPPORTED', True):
+                self.assertEqual((self.BODY, len(compressed)), readResponseBody(FakeResponse(compressed, 'br')))
+
+
+class TestTransferStats(unittest.TestCase):
+    def test_add(self):
+        stats = TransferStats()
+        stats.add('a', 10, 100)
+        stats.add('a', 20, 200)
+        stats.add('b', 5, 5)
+        self.assertEqual({'a': (2, 30, 300), 'b': (1, 5, 5)}, stats.get())
+
+
+class TestFixtureArchive(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+
+    def tearDown(self):
+        core.network.useFixtureArchive(None)
+        os.remove(self.path)
+
+    def test_record_replay(self):
+        with FixtureArchive(self.path, FixtureMode.RECORD) as archive:
+            archive.metadata['queries'] = {'shop': ['Shock']}
+            archive.store('GET', 'http://shop/a', None, b'a')
+            archive.store('POST', 'http://shop/a', 'q=1', b'b')
+            archive.store('GET', 'http://shop/a', None, b'c')
+            self.assertEqual(2, archive.getEntriesCount())
+        with FixtureArchive(self.path, FixtureMode.REPLAY) as archive:
+            self.assertEqual({'queries': {'shop': ['Shock']}}, archive.metadata)
+            self.assertEqual(b'a', archive.load('GET', 'http://shop/a', None))
+            self.assertEqual(b'b', archive.load('POST', 'http://shop/a', 'q=1'))
+            self.assertIsNone(archive.load('GET', 'http://shop/b', None))
+
+    def test_version(self):
+        with zipfile.ZipFile(self.path, 'w') as archive:
+            archive.writestr(FixtureArchive.MANIFEST_NAME, json.dumps({'version': 0, 'metadata': {}, 'entries': []}))
+        self.assertRaises(ValueError, FixtureArchive, self.path, FixtureMode.REPLAY)
+
+    def test_get_url(self):
+        with FixtureArchive(self.path, FixtureMode.RECORD) as archive:
+            archive.store('GET', 'http://shop.invalid/a', None, b'a')
+            archive.store('POST', 'http://shop.invalid/a', 'q=1', b'b')
+        with FixtureArchive(self.path, FixtureMode.REPLAY) as archive:
+            core.network.useFixtureArchive(archive)
+            logger = StderrLogger('test')
+            self.assertEqual(b'a', core.network.getUrl('http://shop.invalid/a', logger))
+            self.assertEqual(b'b', core.network.getUrl('http://shop.invalid/a', logger, {'q': 1}))
+            self.assertRaises(FixtureMissingError, core.network.getUrl, 'http://shop.invalid/b', logger)
+
+
+class StallingServer(object):
+    # Accepts connections and never answers
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.url = 'http://127.0.0.1:{}/'.format(self.listener.getsockname()[1])
+        self.connections = []
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                self.connections.append(self.listener.accept()[0])
+            except OSError:
+                return
+
+    def close(self):
+        self.listener.close()
+        for connection in self.connections:
+            connection.close()
+
+
+class TestGetUrlTimeout(unittest.TestCase):
+    def setUp(self):
+        self.server = StallingServer()
+
+    def tearDown(self):
+        self.server.close()
+        core.network.CIRCUIT_BREAKER.recordSuccess('127.0.0.1')
+
+    def test_deadline(self):
+        policy = RetryPolicy(baseDelay=0.01, maxDelay=0.01, deadline=0.5, attemptTimeout=0.2)
+        started = time.monotonic()
+        self.assertRaises((socket.timeout, urllib.error.URLError), core.network.getUrl, self.server.url, StderrLogger('test'), retryPolicy=policy)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertGreater(len(self.server.connections), 1)
+
+
+class CountingServer(http.server.HTTPServer):
+    # Keep-alive HTTP server that counts accepted connections and can drop them after every response
+    def __init__(self, body: bytes):
+        super().__init__(('127.0.0.1', 0), CountingRequestHandler)
+        self.body = body
+        self.status = 200
+        self.closeAfterResponse = False
+        self.responseDelay = 0
+        self.bodyDelay = 0
+        self.connectionsCount = 0
+        self.closedConnectionsCount = 0
+        self.requestsCount = 0
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_request(self):
+        self.connectionsCount += 1
+        return super().get_request()
+
+    def process_request(self, request, client_address):
+        # Every connection is served in its own thread, so that idle keep-alive connections do not block new ones
+        threading.Thread(target=self.process_request_thread, args=(request, client_address), daemon=True).start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except ConnectionError:
+            pass
+        finally:
+            self.shutdown_request(request)
+            self.closedConnectionsCount += 1
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CountingRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requestsCount += 1
+        time.sleep(self.server.responseDelay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        time.sleep(self.server.bodyDelay)
+        self.wfile.write(self.server.body)
+        if self.server.closeAfterResponse:
+            self.close_connection = True
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpServerTest(unittest.TestCase):
+    BODY = b'<html>' + b'x' * 100000 + b'</html>'
+
+    def setUp(self):
+        core.network.CONNECTION_POOL.clear()
+        self.server = CountingServer(self.BODY)
+        self.logger = StderrLogger('test')
+
+    def tearDown(self):
+        core.network.CONNECTION_POOL.clear()
+        self.server.stop()
+        core.network.CIRCUIT_BREAKER.recordSuccess('127.0.0.1')
+
+
+class TestKeepAlive(HttpServerTest):
+    def test_reuse(self):
+        for _ in range(3):
+            self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual(3, self.server.requestsCount)
+        self.assertEqual(1, self.server.connectionsCount)
+
+    def test_stale_connection(self):
+        self.server.closeAfterResponse = True
+        for _ in range(3):
+            self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual(3, self.server.requestsCount)
+        self.assertEqual(3, self.server.connectionsCount)
+
+    def test_release_after_body(self):
+        opener = urllib.request.build_opener(KeepAliveHTTPHandler)
+        response = opener.open(self.server.url)
+        self.assertEqual(self.BODY[:10], response.read(10))
+        # Connection with unread body is not in the pool, so another request needs a new one
+        self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual(2, self.server.connectionsCount)
+        self.assertEqual(self.BODY[10:], response.read())
+        response.close()
+        for _ in range(2):
+            self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual(2, self.server.connectionsCount)
+
+    def test_reused_connection_timeout(self):
+        shortPolicy = RetryPolicy(maxAttempts=1, deadline=5, attemptTimeout=0.2)
+        self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger, retryPolicy=shortPolicy))
+        self.server.responseDelay = 0.4
+        self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual((2, 1), (self.server.requestsCount, self.server.connectionsCount))
+        started = time.monotonic()
+        self.assertRaises((socket.timeout, urllib.error.URLError), core.network.getUrl, self.server.url, self.logger, retryPolicy=shortPolicy)
+        self.assertLess(time.monotonic() - started, 0.35)
+        self.assertEqual((3, 1), (self.server.requestsCount, self.server.connectionsCount))
+
+    def test_failed_response_closed(self):
+        policy = RetryPolicy(maxAttempts=1, deadline=5, attemptTimeout=0.2)
+        self.server.status = 500
+        with self.assertRaises(urllib.error.HTTPError) as errorContext:
+            core.network.getUrl(self.server.url, self.logger, retryPolicy=policy)
+        self.wait_closed_connections(1)
+        self.server.status = 200
+        self.server.bodyDelay = 0.4
+        with self.assertRaises((socket.timeout, urllib.error.URLError)) as timeoutContext:
+            core.network.getUrl(self.server.url, self.logger, retryPolicy=policy)
+        self.wait_closed_connections(2)
+        self.assertEqual(500, errorContext.exception.code)
+        self.assertIsInstance(timeoutContext.exception, (socket.timeout, urllib.error.URLError))
+
+    def wait_closed_connections(self, count: int):
+        # Failed response is still referenced by the raised exception, so only an explicit close releases its connection
+        started = time.monotonic()
+        while self.server.closedConnectionsCount < count and time.monotonic() - started < 2:
+            time.sleep(0.01)
+        self.assertEqual(count, self.server.closedConnectionsCount)
+
+    def test_partially_read_body(self):
+        opener = urllib.request.build_opener(KeepAliveHTTPHandler)
+        response = opener.open(self.server.url)
+        response.read(10)
+        response.close()
+        self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+        self.assertEqual(2, self.server.connectionsCount)
+
+
+class TestGetUrlCircuitBreaker(HttpServerTest):
+    def test_forbidden_probe(self):
+        breaker = CircuitBreaker(1, 0.05)
+        with mock.patch.object(core.network, 'CIRCUIT_BREAKER', breaker):
+            breaker.recordFailure('127.0.0.1')
+            time.sleep(0.06)
+            self.server.status = 403
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                core.network.getUrl(self.server.url, self.logger)
+            context.exception.close()
+            self.assertEqual(CircuitState.CLOSED, breaker.getState('127.0.0.1'))
+            self.server.status = 200
+            self.assertEqual(self.BODY, core.network.getUrl(self.server.url, self.logger))
+
+
+class TestGetUrlCoalescing(HttpServerTest):
+    def get_concurrently(self, *kwargsList) -> list:
+        results = []
+        threads = [threading.Thread(target=lambda kwargs=kwargs: results.append(core.network.getUrl(self.server.url, self.logger, **kwargs)))
+                   for kwargs in kwargsList]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_same_requests(self):
+        self.server.responseDelay = 0.2
+        self.assertEqual([self.BODY] * 3, self.get_concurrently({}, {}, {}))
+        self.assertEqual(1, self.server.requestsCount)
+
+    def test_different_settings(self):
+        self.server.responseDelay = 0.2
+        self.assertEqual([self.BODY] * 3, self.get_concurrently({}, {'retryPolicy': RetryPolicy(maxAttempts=1)}, {'parametersDict': {'q': 1}}))
+        self.assertEqual(3, self.server.requestsCount)
@@ -0,0 +1,44 @@
+import decimal
+import unittest
+
+from card.offers import CardOffer, pack_offers, unpack_offers
+from core.utils import Currency
+
+
+class TestCardOffer(unittest.TestCase):
+    def test_defaults(self):
+        offer = CardOffer(caption='Shock')
+        self.assertEqual('Shock', offer.caption)
+        self.assertIsNone(offer.id)
+        self.assertIsNone(offer.set)
+        self.assertIsNone(offer.description)
+        self.assertEqual('', offer.source)
+        self.assertRaises(AttributeError, setattr, offer, 'name', 'Shock')
+
+    def test_interning(self):
+        a = CardOffer(set_id=''.join(['M', '19']), language=''.join(['E', 'N']), condition=''.join(['N', 'M']), source=''.join(['mtg', '.ru']))
+        b = CardOffer(set_id=''.join(['M', '1', '9']), language=''.join(['EN']), condition=''.join(['NM']), source=''.join(['mtg.', 'ru']))
+        self.assertIs(a.set, b.set)
+        self.assertIs(a.language, b.language)
+        self.assertIs(a.condition, b.condition)
+        self.assertIs(a.source, b.source)
+
+    def test_copy(self):
+        offer = CardOffer(15, 'Shock', set_id='M19')
+        copy = offer.copy()
+        self.assertEqual(offer, copy)
+        copy.set = None
+        self.assertEqual('M19', offer.set)
+        self.assertNotEqual(offer, copy)
+
+
+class TestOffersBlock(unittest.TestCase):
+    def test_round_trip(self):
+        offers = [
+            CardOffer(15, 'Shock', 'Promo', 'M19', 'EN', 'NM', True, 2, decimal.Decimal('15.50'), Currency.RUR, 'mtg.ru', 'http://mtg.ru/shock'),
+            CardOffer(None, 'Шок', None, None, 'RU', None, False, True, None, None, 'topdeck.ru', 'https://topdeck.ru'),
+        ]
+        unpacked = unpack_offers(pack_offers(offers))
+        self.assertEqual(offers, unpacked)
+        self.assertIs(offers[0].set, unpacked[0].set)
+        self.assertEqual([], unpack_offers(pack_offers([])))
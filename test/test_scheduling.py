@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.scheduling import LatencyHistory, distribute_jobs, get_workers_count
+
+
+class TestWorkersCount(unittest.TestCase):
+    def test_limits(self):
+        self.assertEqual(1, get_workers_count(1, 1))
+        self.assertEqual(1, get_workers_count(16, 1, reserved_cores=1000))
+        self.assertEqual(1, get_workers_count(16, 1 << 60))
+        self.assertLessEqual(get_workers_count(1000, 1), os.cpu_count())
+
+
+class TestDistributeJobs(unittest.TestCase):
+    def test_longest_first(self):
+        latencies = {'a': 1.0, 'b': 5.0, 'c': 2.0, 'd': 2.5}
+        self.assertEqual([['b'], ['d', 'c', 'a']], distribute_jobs(['a', 'b', 'c', 'd'], 2, latencies))
+        self.assertEqual([['b', 'd', 'c', 'a']], distribute_jobs(['a', 'b', 'c', 'd'], 1, latencies))
+
+    def test_unknown_jobs(self):
+        self.assertEqual([['x', 'a'], ['b']], distribute_jobs(['a', 'b', 'x'], 2, {'a': 1.0, 'b': 3.0}))
+        self.assertEqual([['x', 'a']], distribute_jobs(['a', 'x'], 1, {'a': 1.0}))
+        self.assertEqual([['a'], ['b'], ['c']], distribute_jobs(['a', 'b', 'c'], 3, {}))
+
+    def test_groups(self):
+        latencies = {'a': 4.0, 'b': 3.0, 'c': 2.0, 'd': 2.0, 'e': 1.0}
+        self.assertEqual([['a', 'd'], ['b', 'c', 'e']], distribute_jobs(['a', 'b', 'c', 'd', 'e'], 2, latencies))
+        # Group is planned as a single job as long as all of its jobs together
+        groups = {'c': 'mtg', 'd': 'mtg', 'e': 'mtg'}
+        self.assertEqual([['c', 'd', 'e'], ['a', 'b']], distribute_jobs(['a', 'b', 'c', 'd', 'e'], 2, latencies, groups))
+        self.assertEqual([['x', 'c', 'd'], ['a'], ['b']], distribute_jobs(['a', 'b', 'c', 'd', 'x'], 3, latencies, {'c': 'a', 'd': 'a', 'x': 'a'}))
+
+
+class TestLatencyHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'latency.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_update(self):
+        history = LatencyHistory(None, smoothing=0.5)
+        self.assertIsNone(history.get('a'))
+        history.update('a', 10)
+        self.assertEqual(10, history.get('a'))
+        history.update('a', 20)
+        self.assertEqual(15, history.get('a'))
+
+    def test_save(self):
+        history = LatencyHistory(self.path)
+        history.update('a', 1.5)
+        history.save()
+        self.assertEqual({'a': 1.5}, LatencyHistory(self.path).get_all())
+
+    def test_broken_file(self):
+        with open(self.path, 'w') as fobj:
+            fobj.write('[')
+        self.assertEqual({}, LatencyHistory(self.path).get_all())
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import core.network
+from card.sources import CardSource, MtgRu
+from core.network import FixtureArchive, FixtureMode
+from core.utils import StderrLogger
+
+
+class PagedSource(CardSource):
+    def __init__(self, logger, delays=None):
+        super().__init__(logger, 'http://shop.invalid', '/search?q={query}&page={page}')
+        self.delays = delays or {}
+        self.loadedUrls = []
+        self.lock = threading.Lock()
+
+    def getHtml(self, url):
+        with self.lock:
+            self.loadedUrls.append(url)
+        time.sleep(self.delays.get(url, 0))
+        return super().getHtml(url)
+
+    def _getPageCount(self, html):
+        return int(self.select(html, '#pages')[0].text)
+
+    def _getPageCardsCount(self, html):
+        return len(self.select(html, 'tr.card'))
+
+    def _parseResponse(self, queryText, url, html):
+        for row in self.select(html, 'tr.card'):
+            yield {'id': int(row[1].text), 'name': row[0].text, 'source': url}
+
+
+def makePage(title, cardIds=(), pagesCount=1):
+    rows = ''.join('<tr class="card"><td>Shock</td><td>{}</td></tr>'.format(cardId) for cardId in cardIds)
+    return '<html><head><title>{}</title></head><body><table>{}</table><div id="pages">{}</div></body></html>'.format(title, rows, pagesCount).encode('utf-8')
+
+
+def makeExchangeCard(cardId):
+    foil = '<img id="FoilCard">' if cardId % 3 == 0 else ''
+    return '''<table class="CardInfo"><tr><th class="txt0">Shock</th><td><nobr class="txt0">#{0}</nobr></td></tr>
+<tr><td class="txt15"><font>Английский</font></td><td class="txt15"><b>{1} шт.</b> <b>{2} р.</b></td></tr>
+<tr><td><table id="table0"><tr><td><img alt="Magic 2010">{3}</td></tr></table></td></tr></table>'''.format(cardId, cardId % 5 + 1, cardId * 10, foil)
+
+
+def makeExchangeUser(userIndex):
+    cards = ''.join(makeExchangeCard(userIndex * 10 + i) for i in range(3))
+    # Every fourth user is a shop known on its own, so its entry is skipped
+    url = 'http://mtg.ru/exchange/user{}.html'.format(userIndex) if userIndex % 4 else 'http://mtgtrade.net/exchange'
+    return '''<table class="NoteDivWidth"><tr><td><table><tr><th>user{0}</th><td>info</td><td><a href="{1}">list</a></td></tr></table></td></tr>
+<tr><td>{2}</td></tr></table>'''.format(userIndex, url, cards)
+
+
+def makeExchangePage(usersCount):
+    # Entries are nested differently, and page is big enough to be fed to parser in several chunks
+    users = ''.join('<div>{}</div>'.format(makeExchangeUser(i)) if i % 2 else makeExchangeUser(i) for i in range(usersCount))
+    html = '<html><head><meta charset="windows-1251"></head><body><table><tr><td>{}</td></tr></table></body></html>'.format(users)
+    return html.encode('cp1251')
+
+
+class SourceTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = StderrLogger('test')
+        fd, self.path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        self.archive = None
+
+    def tearDown(self):
+        core.network.useFixtureArchive(None)
+        if self.archive is not None:
+            self.archive.close()
+        os.remove(self.path)
+
+    def replay(self, pages: dict):
+        with FixtureArchive(self.path, FixtureMode.RECORD) as archive:
+            for url, body in pages.items():
+                archive.store('GET', url, None, body)
+        self.archive = FixtureArchive(self.path, FixtureMode.REPLAY)
+        core.network.useFixtureArchive(self.archive)
+
+
+class TestHtmlPages(SourceTest):
+    def test_prefetch(self):
+        self.replay({'http://shop.invalid/a': makePage('a')})
+        source = PagedSource(self.logger)
+        html = source.prefetchHtml('/a').result()
+        self.assertEqual('a', html.find('.//title').text)
+        self.assertIs(html, source.getHtml('/a'))
+        source.close()
+        self.assertIsNone(source.requestsExecutor)
+        self.assertEqual(0, len(source.requestCache))
+
+    def test_completion_order(self):
+        self.replay({'http://shop.invalid/slow': makePage('slow'), 'http://shop.invalid/fast': makePage('fast')})
+        source = PagedSource(self.logger, {'/slow': 0.3})
+        pages = [(i, html.find('.//title').text) for i, html in source.getHtmlPages(['/slow', '/fast'])]
+        self.assertEqual([(1, 'fast'), (0, 'slow')], pages)
+        source.close()
+
+    def test_duplicate_urls(self):
+        self.replay({'http://shop.invalid/a': makePage('a'), 'http://shop.invalid/b': makePage('b')})
+        source = PagedSource(self.logger)
+        pages = {i: html.find('.//title').text for i, html in source.getHtmlPages(['/a', '/b', '/a'])}
+        self.assertEqual({0: 'a', 1: 'b', 2: 'a'}, pages)
+        self.assertEqual(['/a', '/b'], sorted(source.loadedUrls))
+        source.close()
+
+
+class TestQuery(SourceTest):
+    def test_prefetched_pages(self):
+        url = 'http://shop.invalid/search?q=Shock&page={}'
+        self.replay({url.format(page): makePage(page, range(page * 10, page * 10 + 3), 3) for page in range(1, 4)})
+        # Later pages are loaded in background, yet offers are still emitted in order of pages
+        source = PagedSource(self.logger, {url.format(2): 0.2})
+        offers = [offer.id for offer in source.query('Shock') if offer is not None]
+        self.assertEqual([10, 11, 12, 20, 21, 22, 30, 31, 32], offers)
+        self.assertEqual(9, source.getFoundCardsCount())
+        self.assertEqual(9, source.getEstimatedCardsCount())
+        source.close()
+
+    def test_streamed(self):
+        streamedSource = MtgRu(self.logger)
+        self.replay({streamedSource._CardSource__getQueryUrl('Shock', 1): makeExchangePage(100)})
+        streamedOffers = [offer for offer in streamedSource.query('Shock') if offer is not None]
+
+        documentSource = MtgRu(self.logger)
+        documentSource.streamedEntry = None
+        documentOffers = [offer for offer in documentSource.query('Shock') if offer is not None]
+
+        self.assertEqual(225, len(streamedOffers))
+        self.assertEqual(documentOffers, streamedOffers)
+        self.assertEqual(documentSource.getFoundCardsCount(), streamedSource.getFoundCardsCount())
+        self.assertEqual(documentSource.getEstimatedCardsCount(), streamedSource.getEstimatedCardsCount())
+
+
+class TestHtmlEntries(SourceTest):
+    def test_incremental(self):
+        source = MtgRu(self.logger)
+        self.replay({'http://mtg.ru/exchange': makeExchangePage(400)})
+        entries = []
+        for entry in source.iterHtmlEntries('/exchange', 'table', 'NoteDivWidth'):
+            self.assertEqual('user{}'.format(len(entries)), source.select(entry, 'tr th')[0].text)
+            # Page is parsed a chunk at a time, and processed entries are cleared and dropped out of the tree
+            self.assertLess(len(source.select(entry.getroottree().getroot(), 'table.NoteDivWidth')), 100)
+            self.assertTrue(all(len(previous) == 0 for previous in entries))
+            entries.append(entry)
+        self.assertEqual(400, len(entries))
+
+
+if __name__ == '__main__':
+    unittest.main()